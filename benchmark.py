@@ -0,0 +1,316 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""
+    Benchmarks for Pydertron's JS/Python bridge.
+
+    Usage: python benchmark.py [--output FILE] [--compare FILE]
+                               [--threshold RATIO] [NAME ...]
+
+    Each benchmark reports the best time per operation over several
+    rounds. Results can be written to a JSON file, and compared against
+    a previously written one to find regressions; when comparing, the
+    exit status is the number of benchmarks that got slower than the
+    threshold allows.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import optparse
+
+from pydertron import JsSandbox, JsExposedObject, jsexposed
+from pydertron import ContextWatchdogThread
+from pydertron import LocalFileSystem, SourceCache, ScriptCache
+from test_http import start_server, make_fs, stop
+
+# Minimum time, in seconds, that each round of a benchmark should take.
+MIN_ROUND_TIME = 0.2
+
+ROUNDS = 3
+
+benchmarks = []
+
+def benchmark(name):
+    """
+    Registers the decorated function as a benchmark. The function is
+    passed a number of iterations to run, and returns the total time
+    they took, so that it can exclude its own setup.
+    """
+
+    def decorator(func):
+        benchmarks.append((name, func))
+        return func
+    return decorator
+
+def timed(sandbox_func):
+    """
+    Returns a benchmark function that times the callable returned by
+    'sandbox_func', which is passed a new sandbox.
+    """
+
+    def run(iterations):
+        sandbox = JsSandbox(LocalFileSystem(os.getcwd()))
+        try:
+            func = sandbox_func(sandbox)
+            start = time.time()
+            for i in xrange(iterations):
+                func()
+            return time.time() - start
+        finally:
+            sandbox.finish()
+    return run
+
+@benchmark('sandbox_construction')
+def bench_sandbox_construction(iterations):
+    fs = LocalFileSystem(os.getcwd())
+    elapsed = 0
+    for i in xrange(iterations):
+        start = time.time()
+        sandbox = JsSandbox(fs)
+        elapsed += time.time() - start
+        sandbox.finish()
+    return elapsed
+
+@jsexposed
+def identity(value):
+    return value
+
+class Point(JsExposedObject):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    @jsexposed
+    def norm(self):
+        return abs(self.x) + abs(self.y)
+
+def wrap_pyobject(sandbox):
+    point = Point(1, 2)
+    return lambda: sandbox.wrap_pyobject(point)
+benchmark('wrap_pyobject')(timed(wrap_pyobject))
+
+def wrap_jsobject(sandbox):
+    jsobject = sandbox.new_object().wrapped_jsobject
+    return lambda: sandbox.wrap_jsobject(jsobject)
+benchmark('wrap_jsobject')(timed(wrap_jsobject))
+
+def get_attribute(sandbox):
+    obj = sandbox.new_object(foo=1)
+    return lambda: obj.foo
+benchmark('object_get_attribute')(timed(get_attribute))
+
+def set_attribute(sandbox):
+    obj = sandbox.new_object()
+    def func():
+        obj.foo = 1
+    return func
+benchmark('object_set_attribute')(timed(set_attribute))
+
+def call_js_function(sandbox):
+    sandbox.run_script("function add(a, b) { return a + b; }")
+    add = sandbox.root.add
+    return lambda: add(1, 2)
+benchmark('js_function_call')(timed(call_js_function))
+
+def call_exposed_function(sandbox):
+    sandbox.set_globals(identity=identity)
+    sandbox.run_script("function callIdentity() { return identity(1); }")
+    return sandbox.root.callIdentity
+benchmark('exposed_function_call')(timed(call_exposed_function))
+
+def call_exposed_method(sandbox):
+    sandbox.set_globals(point=Point(1, 2))
+    sandbox.run_script("function callMethod() { return point.norm(); }")
+    return sandbox.root.callMethod
+benchmark('exposed_method_call')(timed(call_exposed_method))
+
+for size in [0, 10, 1000]:
+    def new_array(sandbox, size=size):
+        contents = range(size)
+        return lambda: sandbox.new_array(*contents)
+    benchmark('new_array_%d' % size)(timed(new_array))
+
+    def new_object(sandbox, size=size):
+        contents = dict(('p%d' % i, i) for i in range(size))
+        return lambda: sandbox.new_object(**contents)
+    benchmark('new_object_%d' % size)(timed(new_object))
+
+# Number of modules in the benchmark module tree, each of which
+# requires the next one.
+MODULE_COUNT = 20
+
+def module_files():
+    files = {}
+    for i in range(MODULE_COUNT):
+        if i + 1 < MODULE_COUNT:
+            contents = "exports.next = require('m%d');" % (i + 1)
+        else:
+            contents = "exports.next = null;"
+        files['m%d.js' % i] = contents + "exports.i = %d;" % i
+    return files
+
+def time_require(fs, iterations, warm):
+    elapsed = 0
+    if warm:
+        script_cache = ScriptCache()
+    for i in xrange(iterations):
+        if not warm:
+            fs.source_cache = SourceCache()
+            script_cache = ScriptCache()
+        sandbox = JsSandbox(fs, script_cache=script_cache)
+        try:
+            start = time.time()
+            sandbox.run_script("require('m0');")
+            elapsed += time.time() - start
+        finally:
+            sandbox.finish()
+    return elapsed
+
+def bench_local_require(warm):
+    def run(iterations):
+        root_dir = tempfile.mkdtemp()
+        try:
+            for name, contents in module_files().items():
+                open(os.path.join(root_dir, name), 'w').write(contents)
+            fs = LocalFileSystem(root_dir, source_cache=SourceCache())
+            return time_require(fs, iterations, warm)
+        finally:
+            shutil.rmtree(root_dir)
+    return run
+
+def bench_http_require(warm):
+    def run(iterations):
+        server = start_server()
+        server.files.update(module_files())
+        fs = make_fs(server)
+        try:
+            return time_require(fs, iterations, warm)
+        finally:
+            stop(server, fs)
+    return run
+
+benchmark('require_cold_local')(bench_local_require(warm=False))
+benchmark('require_warm_local')(bench_local_require(warm=True))
+benchmark('require_cold_http')(bench_http_require(warm=False))
+benchmark('require_warm_http')(bench_http_require(warm=True))
+
+BUSY_LOOP = "for (var i = 0; i < 10000; i++) {}"
+
+for context_count in [1, 100]:
+    def watchdog_overhead(iterations, context_count=context_count):
+        watchdog = ContextWatchdogThread()
+        watchdog.start()
+        fs = LocalFileSystem(os.getcwd())
+        sandboxes = [JsSandbox(fs, watchdog=watchdog)
+                     for i in range(context_count)]
+        try:
+            start = time.time()
+            for i in xrange(iterations):
+                sandboxes[0].run_script(BUSY_LOOP)
+            return time.time() - start
+        finally:
+            for sandbox in sandboxes:
+                sandbox.finish()
+            watchdog.join()
+    benchmark('watchdog_%d_contexts' % context_count)(watchdog_overhead)
+
+def run_benchmark(func):
+    """
+    Returns the best time per iteration of the given benchmark
+    function, calibrating the number of iterations so that each round
+    takes at least MIN_ROUND_TIME seconds.
+    """
+
+    iterations = 1
+    while True:
+        elapsed = func(iterations)
+        if elapsed >= MIN_ROUND_TIME or iterations >= 1000000:
+            break
+        iterations *= 10
+    best = elapsed / iterations
+    for i in range(ROUNDS - 1):
+        best = min(best, func(iterations) / iterations)
+    return dict(per_op = best, iterations = iterations)
+
+def compare(results, baseline, threshold):
+    """
+    Prints a comparison of the given results with the given baseline
+    results, returning the names of benchmarks that got slower by
+    more than the given ratio.
+    """
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]['per_op'] / baseline[name]['per_op']
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print "%-28s %6.2fx%s" % (name, ratio, flag)
+    return regressions
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] [NAME ...]")
+    parser.add_option('--output', help="write results to a JSON file")
+    parser.add_option('--compare', help="compare with a JSON results file")
+    parser.add_option('--threshold', type='float', default=1.1,
+                      help="slowdown ratio treated as a regression")
+    options, names = parser.parse_args()
+
+    results = {}
+    for name, func in benchmarks:
+        if names and name not in names:
+            continue
+        results[name] = run_benchmark(func)
+        print "%-28s %12.2f usec/op" % (name,
+                                        results[name]['per_op'] * 1e6)
+
+    if options.output:
+        json.dump(results, open(options.output, 'w'), indent=2,
+                  sort_keys=True)
+
+    regressions = []
+    if options.compare:
+        print
+        baseline = json.load(open(options.compare))
+        regressions = compare(results, baseline, options.threshold)
+    sys.exit(len(regressions))
@@ -41,11 +41,21 @@
 """
 
 import sys
+import collections
+import contextlib
+import hashlib
+import heapq
+import os
+import re
 import threading
+import thread
+import time
 import traceback
 import weakref
 import types
+import array
 import atexit
+import bisect
 
 import pydermonkey
 
@@ -53,6 +63,10 @@ class ContextWatchdogThread(threading.Thread):
     """
     Watches active JS contexts and triggers their operation callbacks
     at a regular interval.
+
+    Contexts are kept in a heap ordered by when their operation
+    callbacks are next due, so the thread only wakes up when there's
+    work to do, and each context may have its own interval.
     """
 
     # Default interval, in seconds, that the operation callbacks are
@@ -62,41 +76,154 @@ class ContextWatchdogThread(threading.Thread):
     def __init__(self, interval=DEFAULT_INTERVAL):
         threading.Thread.__init__(self)
         self._lock = threading.Lock()
-        self._stop = threading.Event()
-        self._contexts = []
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        # Heap of [deadline, sequence, weakref to context, interval,
+        # active, key] entries; cancelled entries are marked inactive
+        # and discarded once they reach the top of the heap.
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+        self._sequence = 0
         self.interval = interval
 
-    def add_context(self, cx):
+    def _schedule(self, weakcx, interval, deadline):
+        self._sequence += 1
+        entry = [deadline, self._sequence, weakcx, interval, True,
+                 id(weakcx())]
+        heapq.heappush(self._heap, entry)
+        return entry
+
+    def _cancel(self, entry):
+        entry[4] = False
+        self._cancelled += 1
+        if self._cancelled > len(self._heap) / 2:
+            self._heap = [entry for entry in self._heap if entry[4]]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def add_context(self, cx, interval=None):
+        """
+        Starts watching the given context, triggering its operation
+        callback every 'interval' seconds, or at the watchdog's
+        default interval if it's None.
+        """
+
+        self._lock.acquire()
+        try:
+            old_entry = self._entries.get(id(cx))
+            if old_entry is not None:
+                self._cancel(old_entry)
+            next_interval = interval
+            if next_interval is None:
+                next_interval = self.interval
+            entry = self._schedule(weakref.ref(cx), interval,
+                                   time.time() + next_interval)
+            self._entries[id(cx)] = entry
+            if self._heap[0] is entry:
+                self._wakeup.notify()
+        finally:
+            self._lock.release()
+
+    def set_interval(self, cx, interval=None):
+        """
+        Changes the interval at which the given context's operation
+        callback is triggered.
+        """
+
+        self.add_context(cx, interval)
+
+    def remove_context(self, cx):
+        """
+        Stops watching the given context.
+        """
+
         self._lock.acquire()
         try:
-            self._contexts.append(weakref.ref(cx))
+            entry = self._entries.get(id(cx))
+            if entry is not None and entry[2]() is cx:
+                del self._entries[id(cx)]
+                self._cancel(entry)
         finally:
             self._lock.release()
 
     def join(self):
-        self._stop.set()
+        self._lock.acquire()
+        try:
+            self._stopped = True
+            self._wakeup.notify()
+        finally:
+            self._lock.release()
         threading.Thread.join(self)
 
     def run(self):
-        while not self._stop.isSet():
-            new_list = []
-            self._lock.acquire()
-            try:
-                for weakcx in self._contexts:
+        self._lock.acquire()
+        try:
+            while not self._stopped:
+                heap = self._heap
+                now = time.time()
+                while heap and heap[0][0] <= now:
+                    entry = heapq.heappop(heap)
+                    if not entry[4]:
+                        self._cancelled -= 1
+                        continue
+                    weakcx = entry[2]
                     cx = weakcx()
-                    if cx:
-                        new_list.append(weakcx)
-                        cx.trigger_operation_callback()
-                        del cx
-                self._contexts = new_list
-            finally:
-                self._lock.release()
-            self._stop.wait(self.interval)
+                    if cx is None:
+                        if self._entries.get(entry[5]) is entry:
+                            del self._entries[entry[5]]
+                        continue
+                    cx.trigger_operation_callback()
+                    interval = entry[3]
+                    if interval is None:
+                        interval = self.interval
+                    entry[0] = now + interval
+                    heapq.heappush(heap, entry)
+                    del cx
+                if heap:
+                    self._wakeup.wait(heap[0][0] - now)
+                else:
+                    self._wakeup.wait()
+        finally:
+            self._lock.release()
+
+    def _adopt_contexts(self, other):
+        # Starts watching all the live contexts that the given watchdog
+        # is watching. The other watchdog's lock isn't acquired, since
+        # it may have been held by a thread that no longer exists.
+        for entry in list(other._heap):
+            cx = entry[2]()
+            if entry[4] and cx is not None:
+                self.add_context(cx, entry[3])
+            del cx
 
 # Create a global watchdog.
 watchdog = ContextWatchdogThread()
 watchdog.start()
-atexit.register(watchdog.join)
+
+def restart_watchdog():
+    """
+    Replaces the global watchdog with a newly started one that watches
+    the same contexts, returning the new watchdog.
+
+    Threads don't survive os.fork(), so this needs to be called in any
+    child process forked from a process that has already imported this
+    module, before JS code is run in it.
+    """
+
+    global watchdog
+
+    new_watchdog = ContextWatchdogThread(watchdog.interval)
+    new_watchdog._adopt_contexts(watchdog)
+    new_watchdog.start()
+    watchdog = new_watchdog
+    return new_watchdog
+
+def _join_watchdog():
+    if watchdog.isAlive():
+        watchdog.join()
+
+atexit.register(_join_watchdog)
 
 class InternalError(BaseException):
     """
@@ -110,6 +237,126 @@ class InternalError(BaseException):
         BaseException.__init__(self)
         self.exc_info = sys.exc_info()
 
+def _get_global_watchdog():
+    return watchdog
+
+class QuotaExceededError(BaseException):
+    """
+    Raised when JS code exceeds one of its sandbox's resource budgets;
+    like InternalError, it's derived from BaseException so that it
+    unrolls the whole JS/Python stack.
+
+    'resource' is the name of the exceeded budget, 'usage' is a
+    dictionary of the resources used at the time, and 'js_stack' is
+    the JS stack at the time, suitable for passing to format_stack().
+    """
+
+    def __init__(self, resource, limit, usage, js_stack):
+        BaseException.__init__(self, "%s budget of %s exceeded" %
+                               (resource, limit))
+        self.resource = resource
+        self.limit = limit
+        self.usage = usage
+        self.js_stack = js_stack
+
+class Quota(object):
+    """
+    Resource budgets for each call from Python into a sandbox's JS
+    code, e.g. via JsSandbox.run_script() or calling a JS function.
+
+    'wall_time' and 'cpu_time' are in seconds, while 'ticks' is the
+    number of times the sandbox's operation callback may be triggered
+    by its watchdog. 'heap' is the number of bytes by which the whole
+    process's resident memory may grow during the call: the JS heap
+    can't be measured on its own, so memory allocated meanwhile by
+    other threads, or by other sandboxes, counts against the budget
+    too, and memory freed meanwhile counts in its favor. Heap budgets
+    need the process's current resident memory, so they're only
+    supported where /proc/self/statm is available; elsewhere, giving
+    one raises a ValueError rather than leaving it unenforced.
+
+    Budgets that are None are unlimited. Since budgets are checked
+    from the operation callback, they're only enforced as precisely as
+    the watchdog's interval allows.
+    """
+
+    def __init__(self, wall_time=None, cpu_time=None, ticks=None,
+                 heap=None):
+        if heap is not None and _get_rss is None:
+            raise ValueError("Heap budgets aren't supported on this "
+                             "platform")
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.ticks = ticks
+        self.heap = heap
+
+def _get_thread_cpu_clock():
+    """
+    Returns a function that returns the CPU time, in seconds, used by
+    the current thread, falling back to the CPU time used by the whole
+    process on platforms where that isn't available.
+    """
+
+    if hasattr(time, 'thread_time'):
+        return time.thread_time
+    try:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long),
+                        ('tv_nsec', ctypes.c_long)]
+
+        CLOCK_THREAD_CPUTIME_ID = 3
+        libname = (ctypes.util.find_library('rt') or
+                   ctypes.util.find_library('c'))
+        clock_gettime = ctypes.CDLL(libname).clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+        def thread_cpu_time():
+            ts = timespec()
+            if clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)):
+                raise OSError("clock_gettime() failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        thread_cpu_time()
+        return thread_cpu_time
+    except Exception:
+        return time.clock
+
+_thread_cpu_time = _get_thread_cpu_clock()
+
+def _get_rss_reader():
+    """
+    Returns a function that returns the resident memory, in bytes, of
+    the current process, or None if it can't be read on this platform.
+    Peak resident memory, as reported by getrusage(), isn't used
+    instead: it never goes down, so a budget based on it would only
+    trip once the process set a new peak.
+    """
+
+    try:
+        import os
+
+        page_size = os.sysconf('SC_PAGE_SIZE')
+
+        def read_statm():
+            f = open('/proc/self/statm')
+            try:
+                return int(f.read().split()[1]) * page_size
+            finally:
+                f.close()
+
+        read_statm()
+        return read_statm
+    except Exception:
+        return None
+
+_get_rss = _get_rss_reader()
+
+# The greatest possible length of a JS array.
+_MAX_ARRAY_LENGTH = 2 ** 32 - 1
+
 class SafeJsObjectWrapper(object):
     """
     Securely wraps a JS object to behave like any normal Python
@@ -120,7 +367,7 @@ class SafeJsObjectWrapper(object):
     item-based lookup.
     """
 
-    __slots__ = ['_jsobject', '_sandbox', '_this']
+    __slots__ = ['_jsobject', '_sandbox', '_this', '__weakref__']
 
     def __init__(self, sandbox, jsobject, this):
         if not isinstance(jsobject, pydermonkey.Object):
@@ -185,6 +432,25 @@ class SafeJsObjectWrapper(object):
         for property in properties:
             yield property
 
+class FrozenDict(dict):
+    """
+    A dictionary that can't be modified.
+    """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("'%s' object is read-only" % type(self).__name__)
+
+    __setitem__ = __delitem__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((name, _freeze(value[name])) for name in value)
+    elif isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    else:
+        return value
+
 class SafeJsFunctionWrapper(SafeJsObjectWrapper):
     """
     Securely wraps a JS function to behave like any normal Python object.
@@ -197,7 +463,8 @@ class SafeJsFunctionWrapper(SafeJsObjectWrapper):
         SafeJsObjectWrapper.__init__(self, sandbox, jsfunction, this)
 
     def __call__(self, *args):
-        cx = self._sandbox.cx
+        sandbox = self._sandbox
+        cx = sandbox.cx
         jsobject = self._jsobject
         this = self._this
 
@@ -205,35 +472,115 @@ class SafeJsFunctionWrapper(SafeJsObjectWrapper):
         for arg in args:
             arglist.append(self._wrap_to_js(arg))
 
-        obj = cx.call_function(this, jsobject, tuple(arglist))
+        sandbox._enter_js()
+        try:
+            obj = cx.call_function(this, jsobject, tuple(arglist))
+        finally:
+            sandbox._leave_js()
         return self._wrap_to_python(obj)
 
-def format_stack(js_stack, open=open):
+def _get_frameinfo(js_stack):
+    """
+    Returns a dictionary with the filename, line number and function
+    name of the topmost frame of the given JS stack, or None if the
+    frame isn't executing JS code.
+    """
+
+    script = js_stack['script']
+    function = js_stack['function']
+    if script:
+        return dict(filename = script.filename,
+                    lineno = js_stack['lineno'],
+                    name = '<module>')
+    elif function and not function.is_python:
+        return dict(filename = function.filename,
+                    lineno = js_stack['lineno'],
+                    name = function.name)
+    else:
+        return None
+
+class LineCache(object):
+    """
+    A bounded, least-recently-used cache of the lines of source files
+    shown in stack tracebacks, keyed by filename and the function used
+    to open the file. At most 'max_entries' such pairs are kept, so
+    the cache holds on to a bounded number of file systems whatever
+    number of them are used. The file systems invalidate a file's
+    entries whenever they load new contents for it.
+    """
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def getlines(self, filename, open=open):
+        """
+        Returns a list of the lines of the given file, opening it with
+        the given function if they aren't already cached.
+        """
+
+        key = (filename, open)
+        self._lock.acquire()
+        try:
+            lines = self._entries.pop(key, None)
+            if lines is not None:
+                self._entries[key] = lines
+                return lines
+        finally:
+            self._lock.release()
+
+        lines = open(filename).readlines()
+
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+            self._entries[key] = lines
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        finally:
+            self._lock.release()
+        return lines
+
+    def invalidate(self, filename=None):
+        """
+        Removes the lines of the given file, or of all files if no
+        filename is given, from the cache.
+        """
+
+        self._lock.acquire()
+        try:
+            if filename is None:
+                self._entries.clear()
+            else:
+                for key in [key for key in self._entries
+                            if key[0] == filename]:
+                    del self._entries[key]
+        finally:
+            self._lock.release()
+
+line_cache = LineCache()
+
+def format_stack(js_stack, open=open, line_cache=line_cache):
     """
     Returns a formatted Python-esque stack traceback of the given
-    JS stack.
+    JS stack. Source lines are read via the given 'open' function,
+    through the given LineCache unless it's None.
     """
 
     STACK_LINE  ="  File \"%(filename)s\", line %(lineno)d, in %(name)s"
 
     lines = []
     while js_stack:
-        script = js_stack['script']
-        function = js_stack['function']
-        if script:
-            frameinfo = dict(filename = script.filename,
-                             lineno = js_stack['lineno'],
-                             name = '<module>')
-        elif function and not function.is_python:
-            frameinfo = dict(filename = function.filename,
-                             lineno = js_stack['lineno'],
-                             name = function.name)
-        else:
-            frameinfo = None
+        frameinfo = _get_frameinfo(js_stack)
         if frameinfo:
             lines.insert(0, STACK_LINE % frameinfo)
             try:
-                filelines = open(frameinfo['filename']).readlines()
+                if line_cache is None:
+                    filelines = open(frameinfo['filename']).readlines()
+                else:
+                    filelines = line_cache.getlines(frameinfo['filename'],
+                                                    open)
                 line = filelines[frameinfo['lineno'] - 1].strip()
                 lines.insert(1, "    %s" % line)
             except Exception:
@@ -242,6 +589,176 @@ def format_stack(js_stack, open=open):
     lines.insert(0, "Traceback (most recent call last):")
     return '\n'.join(lines)
 
+class JsProfile(object):
+    """
+    A statistical profile of JS code, built from samples of the JS
+    stack taken every 'interval' seconds; see JsSandbox.profile().
+
+    'samples' maps stacks to the number of times they were sampled,
+    where each stack is a tuple of (filename, lineno, name) frames,
+    outermost first.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = {}
+        self.total = 0
+
+    def add_sample(self, js_stack):
+        """
+        Records a sample of the given JS stack.
+        """
+
+        frames = []
+        while js_stack:
+            frameinfo = _get_frameinfo(js_stack)
+            if frameinfo:
+                frames.append((frameinfo['filename'], frameinfo['lineno'],
+                               frameinfo['name']))
+            js_stack = js_stack['caller']
+        if frames:
+            frames.reverse()
+            frames = tuple(frames)
+            self.samples[frames] = self.samples.get(frames, 0) + 1
+            self.total += 1
+
+    def collapsed(self, lines=False):
+        """
+        Returns the profile in the collapsed stack format used by
+        flame graph tools, with one line per distinct stack. Frames are
+        labeled by function name and filename, plus line number if
+        'lines' is true.
+        """
+
+        counts = {}
+        for frames, count in self.samples.iteritems():
+            labels = []
+            for filename, lineno, name in frames:
+                if lines:
+                    labels.append("%s (%s:%d)" % (name, filename, lineno))
+                else:
+                    labels.append("%s (%s)" % (name, filename))
+            key = ';'.join(labels)
+            counts[key] = counts.get(key, 0) + count
+        return '\n'.join("%s %d" % (key, counts[key])
+                         for key in sorted(counts))
+
+    def stats(self):
+        """
+        Returns a list of (self_samples, cumulative_samples, filename,
+        lineno, name) tuples for each line of JS code that was
+        sampled, ordered by decreasing number of self samples.
+        """
+
+        own = {}
+        cumulative = {}
+        for frames, count in self.samples.iteritems():
+            own[frames[-1]] = own.get(frames[-1], 0) + count
+            for frame in set(frames):
+                cumulative[frame] = cumulative.get(frame, 0) + count
+        rows = [(own.get(frame, 0), cumulative[frame]) + frame
+                for frame in cumulative]
+        rows.sort(key=lambda row: (-row[0], -row[1], row[2:]))
+        return rows
+
+    def print_stats(self, stream=None, limit=None):
+        """
+        Prints a table of the profile's stats in a format similar to
+        that of the pstats module, estimating times from the number of
+        samples taken.
+        """
+
+        if stream is None:
+            stream = sys.stdout
+        rows = self.stats()
+        if limit is not None:
+            rows = rows[:limit]
+        stream.write("%d samples at %s second intervals\n\n" %
+                     (self.total, self.interval))
+        stream.write("   samples   tottime   cumtime "
+                     "filename:lineno(function)\n")
+        for own, cumulative, filename, lineno, name in rows:
+            stream.write("%10d %9.3f %9.3f %s:%d(%s)\n" %
+                         (own, own * self.interval,
+                          cumulative * self.interval,
+                          filename, lineno, name))
+
+class Histogram(object):
+    """
+    Counts observed values, such as durations in seconds, in buckets
+    with the given upper bounds, along with their total count and sum.
+    """
+
+    DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+                       0.5, 1, 5, 10)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        """
+        Returns a dictionary with the histogram's count and sum, and
+        its buckets as a list of (upper bound, cumulative count)
+        tuples, the last of which has an upper bound of infinity.
+        """
+
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + (_INFINITY,), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return dict(count = self.count, sum = self.sum, buckets = buckets)
+
+def _format_prometheus_labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return (unicode(value).replace('\\', '\\\\')
+                .replace('"', '\\"').replace('\n', '\\n'))
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value))
+                             for name, value in sorted(labels.items()))
+
+def format_prometheus(stats, prefix='pydertron_', labels=None):
+    """
+    Formats the given statistics, as returned by JsSandbox.stats(), in
+    the Prometheus text exposition format. 'labels' is an optional
+    dictionary of labels to add to every sample, e.g. to identify the
+    sandbox.
+    """
+
+    labels = dict(labels or {})
+    label_str = _format_prometheus_labels(labels)
+    lines = []
+    for name, value in sorted(stats['counters'].items()):
+        name = '%s%s_total' % (prefix, name)
+        lines.append('# TYPE %s counter' % name)
+        lines.append('%s%s %r' % (name, label_str, value))
+    for name, value in sorted(stats['gauges'].items()):
+        name = prefix + name
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s%s %r' % (name, label_str, value))
+    for name, histogram in sorted(stats['histograms'].items()):
+        name = prefix + name
+        lines.append('# TYPE %s histogram' % name)
+        for bound, count in histogram['buckets']:
+            if bound == _INFINITY:
+                bound = '+Inf'
+            bucket_labels = dict(labels, le=bound)
+            lines.append('%s_bucket%s %d' % (
+                    name, _format_prometheus_labels(bucket_labels), count))
+        lines.append('%s_sum%s %r' % (name, label_str, histogram['sum']))
+        lines.append('%s_count%s %d' % (name, label_str,
+                                        histogram['count']))
+    return "\n".join(lines) + "\n"
+
 def jsexposed(name=None, on=None):
     """
     Decorator used to expose the decorated function or method to
@@ -275,6 +792,256 @@ class JsExposedObject(object):
 
     pass
 
+class JsBuffer(JsExposedObject):
+    """
+    Exposes the items of a bytearray, array.array, memoryview, buffer
+    or str to JS without copying them, optionally limited to the items
+    from 'start' up to 'end'. JsSandbox.wrap_pyobject() automatically
+    wraps bytearrays, arrays, memoryviews and buffers in these.
+
+    JS code can read and write individual items via get() and set(),
+    take zero-copy views of a range of items via slice(), and read and
+    write ranges of items as strings whose character codes are the
+    items' values via read() and write(). Writing to a read-only
+    buffer, such as a str, throws a JS exception. Note that JS code
+    can't use index syntax (e.g. 'buf[0]') on these objects, since
+    pydermonkey provides no way to intercept property access.
+    """
+
+    __jsprops__ = ['length', 'readonly']
+
+    def __init__(self, data, start=0, end=None):
+        if isinstance(data, (bytearray, array.array)):
+            readonly = False
+        elif isinstance(data, memoryview):
+            if data.itemsize != 1:
+                raise TypeError("Only memoryviews of bytes are supported")
+            readonly = data.readonly
+        elif isinstance(data, (str, buffer)):
+            readonly = True
+        else:
+            raise TypeError("Can't expose objects of type '%s' as "
+                            "buffers" % type_info(data))
+        if (isinstance(data, (bytearray, array.array)) and
+            getattr(data, 'typecode', 'B') not in 'cu'):
+            self.__decode = self.__encode = None
+        elif getattr(data, 'typecode', None) == 'u':
+            self.__decode = ord
+            self.__encode = unichr
+        else:
+            self.__decode = ord
+            self.__encode = chr
+        self.data = data
+        self.__readonly = readonly
+        self.__start = start
+        self.__end = end
+
+    @property
+    def length(self):
+        if self.__end is None:
+            return max(len(self.data) - self.__start, 0)
+        return max(min(self.__end, len(self.data)) - self.__start, 0)
+
+    @property
+    def readonly(self):
+        return self.__readonly
+
+    def __integer(self, value, lower, upper, message):
+        # Converts the given JS number into an integer, as long as it's
+        # integral and in the range [lower, upper].
+        if (isinstance(value, float) and value.is_integer()):
+            value = int(value)
+        if (isinstance(value, bool) or
+            not isinstance(value, (int, long)) or
+            not lower <= value <= upper):
+            raise pydermonkey.error(message)
+        return value
+
+    def __index(self, index, upper):
+        # Converts the given JS number into an absolute index into the
+        # data, as long as it's in the range [0, upper].
+        return self.__start + self.__integer(index, 0, upper,
+                                             "Index out of range")
+
+    def __check_writable(self):
+        if self.__readonly:
+            raise pydermonkey.error("Buffer is read-only")
+
+    def __range(self, start, count):
+        length = self.length
+        begin = self.__index(start, length)
+        if count is None or count is pydermonkey.undefined:
+            return begin, self.__start + length
+        count = self.__integer(count, 0, length - (begin - self.__start),
+                               "Count out of range")
+        return begin, begin + count
+
+    def __store(self, index, value):
+        # JS numbers are all floats, so integral ones are stored as
+        # integers.
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if self.__encode is not None:
+            if (isinstance(value, bool) or
+                not isinstance(value, (int, long))):
+                raise TypeError("Expected an integer")
+            value = self.__encode(value)
+        self.data[index] = value
+
+    @jsexposed
+    def get(self, index):
+        value = self.data[self.__index(index, self.length - 1)]
+        if self.__decode is not None:
+            value = self.__decode(value)
+        return value
+
+    @jsexposed
+    def set(self, index, value):
+        self.__check_writable()
+        index = self.__index(index, self.length - 1)
+        try:
+            self.__store(index, value)
+        except (TypeError, ValueError, OverflowError), e:
+            raise pydermonkey.error("Invalid value: %s" % e)
+
+    @jsexposed
+    def slice(self, start, end=None):
+        length = self.length
+        if end is None:
+            end = length
+        try:
+            begin, end, step = slice(int(start), int(end)).indices(length)
+        except (TypeError, ValueError, OverflowError):
+            raise pydermonkey.error("Invalid slice")
+        return JsBuffer(self.data, self.__start + begin,
+                        self.__start + max(begin, end))
+
+    @jsexposed
+    def read(self, start=0, count=None):
+        begin, end = self.__range(start, count)
+        items = self.data[begin:end]
+        if isinstance(items, memoryview):
+            items = items.tobytes()
+        elif isinstance(items, array.array) and items.typecode == 'c':
+            items = items.tostring()
+        elif isinstance(items, array.array) and items.typecode == 'u':
+            return items.tounicode()
+        if isinstance(items, (bytearray, buffer, str)):
+            return str(items).decode('latin-1')
+        try:
+            return u''.join(unichr(item) for item in items)
+        except (TypeError, ValueError), e:
+            raise pydermonkey.error("Can't read items as a string: %s" % e)
+
+    @jsexposed
+    def write(self, string, start=0):
+        self.__check_writable()
+        if not isinstance(string, basestring):
+            raise pydermonkey.error("Expected a string")
+        begin, end = self.__range(start, len(string))
+        try:
+            if isinstance(self.data, (bytearray, memoryview)):
+                self.data[begin:end] = unicode(string).encode('latin-1')
+            else:
+                for i in range(len(string)):
+                    self.__store(begin + i, ord(string[i]))
+        except (TypeError, ValueError, OverflowError,
+                UnicodeError), e:
+            raise pydermonkey.error("Invalid value: %s" % e)
+
+def _get_arity(func):
+    """
+    Returns a (min_args, max_args) tuple describing the number of
+    arguments the given method takes, not counting 'self'. 'max_args'
+    is None if the number of arguments is unlimited.
+    """
+
+    import inspect
+
+    try:
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+    except TypeError:
+        return (0, None)
+    max_args = max(len(args) - 1, 0)
+    min_args = max(max_args - len(defaults or ()), 0)
+    if varargs:
+        max_args = None
+    return (min_args, max_args)
+
+def _describe_arity(name, min_args, max_args):
+    """
+    Returns an error message, with a '%d' placeholder for the number of
+    arguments actually given, for calls to the given function with the
+    wrong number of arguments.
+    """
+
+    if max_args is None:
+        expected = "at least %d" % min_args
+    elif min_args == max_args:
+        expected = "exactly %d" % min_args
+    else:
+        expected = "%d to %d" % (min_args, max_args)
+    return "%s() takes %s argument(s) (%%d given)" % (name, expected)
+
+class _ExposedClassInfo(object):
+    """
+    The JS-exposed properties and methods of a JsExposedObject
+    subclass, along with the number of arguments each method takes.
+    Methods are stored as plain functions, since unbound methods
+    reference their class, which would keep the class's entry in
+    _exposed_classes alive forever.
+    """
+
+    def __init__(self, pyproto):
+        self.properties = []
+        for name in getattr(pyproto, '__jsprops__', []):
+            prop = getattr(pyproto, name)
+            if not type(prop) == property:
+                raise TypeError("Expected attribute '%s' to "
+                                "be a property" % name)
+            self.properties.append((name, prop.fget, prop.fset))
+
+        self.methods = []
+        for name in dir(pyproto):
+            attr = getattr(pyproto, name)
+            if (isinstance(attr, types.UnboundMethodType) and
+                hasattr(attr, '__jsexposed__') and
+                attr.__jsexposed__):
+                self.methods.append((name, attr.im_func, _get_arity(attr)))
+
+# Process-wide registry of _ExposedClassInfo objects, keyed by class,
+# so that each class only needs to be examined once.
+_exposed_classes = weakref.WeakKeyDictionary()
+
+def _get_exposed_class_info(pyproto):
+    info = _exposed_classes.get(pyproto)
+    if info is None:
+        info = _ExposedClassInfo(pyproto)
+        _exposed_classes[pyproto] = info
+    return info
+
+def _finished_sandbox(*args):
+    raise pydermonkey.error("Sandbox has been finished")
+
+class _Bridge(object):
+    """
+    Holds the sandbox methods used by the wrappers of Python functions
+    exposed to JS, so that the wrappers don't reference the sandbox
+    directly; this allows JsSandbox.finish() to break the reference
+    cycle for wrappers of functions it no longer knows about.
+    """
+
+    __slots__ = ['wrap', 'wrap_result', 'calls']
+
+    def __init__(self, sandbox):
+        self.calls = 0
+        self.wrap = sandbox.wrap_jsobject
+        self.wrap_result = sandbox.wrap_pyobject
+
+    def clear(self):
+        self.wrap = _finished_sandbox
+        self.wrap_result = _finished_sandbox
+
 def type_info(value):
     """
     Returns extended type information as string.
@@ -285,60 +1052,770 @@ def type_info(value):
         type_name = "instance of %s " % value.__class__
     return type_name
 
-
-class JsSandbox(object):
+class ScriptCache(object):
     """
-    A JS runtime and associated functionality capable of securely
-    loading and executing scripts.
+    A bounded, least-recently-used cache of compiled JS scripts, keyed
+    by filename and a hash of the script's contents.
+
+    Compiled scripts belong to the JS runtime that compiled them, so an
+    entry is only ever reused by sandboxes using the same runtime; a
+    sandbox's entries are purged when it's finished. Each runtime has
+    its own budget of 'max_entries' scripts, so that one sandbox
+    running many one-off scripts can't evict the modules compiled for
+    other sandboxes.
     """
 
-    def __init__(self, fs, watchdog=watchdog, opcb=None):
-        rt = pydermonkey.Runtime()
-        cx = rt.new_context()
-        root_proto = cx.new_object()
-        cx.init_standard_classes(root_proto)
-        root = cx.new_object(None, root_proto)
+    # Default maximum number of compiled scripts kept for each runtime.
+    DEFAULT_MAX_ENTRIES = 512
 
-        cx.set_operation_callback(self._opcb)
-        cx.set_throw_hook(self._throwhook)
-        watchdog.add_context(cx)
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        # Maps runtimes to ordered dictionaries of their scripts.
+        self._runtimes = {}
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
 
-        self.fs = fs
-        self.opcb = opcb
-        self.rt = rt
-        self.cx = cx
-        self.curr_exc = None
-        self.py_stack = None
-        self.js_stack = None
-        self.__modules = {}
-        self.__py_to_js = {}
-        self.__type_protos = {}
-        self.__globals = {}
-        self.__root_proto = root_proto
-        self.root = self.wrap_jsobject(root, root)
+    def __len__(self):
+        self._lock.acquire()
+        try:
+            return sum(len(scripts) for scripts in self._runtimes.values())
+        finally:
+            self._lock.release()
 
-    def set_globals(self, **globals):
+    def compile(self, rt, cx, obj, contents, filename, lineno):
         """
-        Sets the global properties for the root object and all global
-        scopes (e.g., SecurableModules).  This should be called before
-        any scripts are executed.
+        Returns a compiled pydermonkey.Script for the given contents,
+        compiling them with the given context if they haven't already
+        been compiled for the given runtime.
         """
 
-        self.__globals.update(globals)
-        self._install_globals(self.root)
+        if isinstance(contents, unicode):
+            digest = hashlib.sha1(contents.encode('utf-8')).digest()
+        else:
+            digest = hashlib.sha1(contents).digest()
+        key = (filename, lineno, digest)
 
-    def finish(self):
-        """
-        Cleans up all resources used by the sandbox, breaking any reference
-        cycles created due to issue #2 in pydermonkey:
+        self._lock.acquire()
+        try:
+            scripts = self._runtimes.get(rt)
+            if scripts is not None:
+                script = scripts.pop(key, None)
+                if script is not None:
+                    scripts[key] = script
+                    self.hits += 1
+                    return script
+            self.misses += 1
+        finally:
+            self._lock.release()
 
-        http://code.google.com/p/pydermonkey/issues/detail?id=2
+        script = cx.compile_script(obj, contents, filename, lineno)
+
+        self._lock.acquire()
+        try:
+            scripts = self._runtimes.setdefault(rt,
+                                                collections.OrderedDict())
+            scripts[key] = script
+            while len(scripts) > self.max_entries:
+                scripts.popitem(last=False)
+        finally:
+            self._lock.release()
+        return script
+
+    def purge(self, rt):
+        """
+        Removes all scripts compiled for the given runtime.
         """
 
-        for jsobj in self.__py_to_js.values():
-            self.cx.clear_object_private(jsobj)
+        self._lock.acquire()
+        try:
+            self._runtimes.pop(rt, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._runtimes.clear()
+        finally:
+            self._lock.release()
+
+# Create a global compiled script cache.
+script_cache = ScriptCache()
+
+def _check_tree(value, max_depth, max_size):
+    """
+    Checks that the given Python value, which may be an arbitrarily
+    nested structure of lists, tuples and dictionaries, is within the
+    given depth and size limits, raising a ValueError if it isn't.
+
+    Returns whether the value is a tree of JSON-compatible data, i.e.
+    it contains no shared or cyclic references.
+    """
+
+    seen = set()
+    count = [0]
+
+    def walk(value, depth):
+        count[0] += 1
+        if count[0] > max_size:
+            raise ValueError("Value consists of more than %d items" %
+                             max_size)
+        if isinstance(value, (list, tuple, dict)):
+            if id(value) in seen:
+                return False
+            seen.add(id(value))
+            if depth >= max_depth:
+                raise ValueError("Value is nested more than %d levels deep" %
+                                 max_depth)
+            plain = True
+            if isinstance(value, dict):
+                for name in value:
+                    if not isinstance(name, basestring):
+                        raise TypeError("Object property names must be "
+                                        "strings, not '%s'" %
+                                        type_info(name))
+                    plain = walk(value[name], depth + 1) and plain
+            else:
+                for item in value:
+                    plain = walk(item, depth + 1) and plain
+            return plain
+        elif isinstance(value, float):
+            return value == value and value not in (_INFINITY, -_INFINITY)
+        else:
+            return (value is None or
+                    isinstance(value, (bool, int, long, basestring)))
+
+    return walk(value, 0)
+
+_INFINITY = float('inf')
+
+# Source code for JS functions used internally by JsSandbox, keyed by
+# name. Each function is given the intrinsic functions it needs, since
+# untrusted JS may have tampered with their global counterparts.
+_JS_HELPERS = {
+    # Reads the given properties of 'obj' once each, returning the
+    # JSON-encoded list of their values along with an array of those
+    # that are objects. Each value is encoded as [] if it's undefined,
+    # as a string if it's a number that JSON can't represent, as 0 if
+    # it's an object (i.e. the next item of the array), and as [value]
+    # otherwise.
+    'get_many': """
+        (function(obj, names, parse, stringify) {
+          names = parse(names);
+          var values = [];
+          var objects = [];
+          for (var i = 0; i < names.length; i++) {
+            var value = obj[names[i]];
+            if (typeof(value) == 'undefined')
+              values[i] = [];
+            else if (value !== value)
+              values[i] = 'NaN';
+            else if (value === 1 / 0)
+              values[i] = 'Infinity';
+            else if (value === -1 / 0)
+              values[i] = '-Infinity';
+            else if (value === 0 && 1 / value < 0)
+              values[i] = '-0';
+            else if (value === null ||
+                (typeof(value) != 'object' && typeof(value) != 'function'))
+              values[i] = [value];
+            else {
+              values[i] = 0;
+              objects[objects.length] = value;
+            }
+          }
+          return [stringify(values), objects];
+        })
+        """,
+    'key_iterator': """
+        (function(Iterator, obj) {
+          return Iterator(obj, true);
+        })
+        """,
+    'next_keys': """
+        (function(iter, next, obj, count, invoke, hasOwnProperty,
+                  stopIteration, stringify) {
+          var keys = [];
+          var done = false;
+          try {
+            while (keys.length < count) {
+              var key = invoke(next, iter, []);
+              if (invoke(hasOwnProperty, obj, [key]))
+                keys[keys.length] = key;
+            }
+          } catch (e) {
+            if (e !== stopIteration)
+              throw e;
+            done = true;
+          }
+          return stringify([done, keys]);
+        })
+        """,
+    # Stringifies the given value, giving up and returning null once
+    # more than 'maxSize' values have been visited; omitted values,
+    # such as functions, are counted too, since they become null in
+    # arrays.
+    'bounded_stringify': """
+        (function(value, stringify, maxSize) {
+          var count = 0;
+          var tooBig = {};
+          function countValues(key, item) {
+            if (++count > maxSize)
+              throw tooBig;
+            return item;
+          }
+          try {
+            return stringify(value, countValues);
+          } catch (e) {
+            if (e === tooBig)
+              return null;
+            throw e;
+          }
+        })
+        """,
+    'clear_regexp_statics': """
+        (function(invoke, exec) {
+          invoke(exec, /(?:)/, ['']);
+        })
+        """,
+    'call_many': """
+        (function(func, thisObj, argsList, invoke) {
+          var results = [];
+          for (var i = 0; i < argsList.length; i++)
+            results[i] = invoke(func, thisObj, argsList[i]);
+          return results;
+        })
+        """,
+    # Only used where Function.prototype.bind() isn't available; the
+    # property name is a secret, so JS code can't interfere with it.
+    'make_invoke': """
+        (function(apply, key) {
+          return function(func, thisObj, args) {
+            func[key] = apply;
+            try {
+              return func[key](thisObj, args);
+            } finally {
+              delete func[key];
+            }
+          };
+        })
+        """,
+    }
+
+# The standard global properties, along with the names of the
+# standard properties of each global constructor or object and of its
+# prototype, that JsSandbox.reset() checks for tampering (in addition
+# to 'prototype', 'constructor' and '__proto__', which are checked
+# for all of them, and to any enumerable properties). Where
+# Object.getOwnPropertyNames() is available, every own property of
+# these objects is checked instead, so the table only matters for
+# older versions of SpiderMonkey, in which the non-enumerable
+# properties of an object can't be listed.
+_STANDARD_GLOBALS = (
+    'Object Function Array String Boolean Number Date RegExp Math JSON '
+    'Error EvalError RangeError ReferenceError SyntaxError TypeError '
+    'URIError Iterator StopIteration eval parseInt parseFloat isNaN '
+    'isFinite decodeURI decodeURIComponent encodeURI encodeURIComponent '
+    'escape unescape uneval NaN Infinity undefined'
+    ).split()
+
+_ARRAY_METHODS = (
+    'join reverse sort push pop shift unshift splice concat slice '
+    'indexOf lastIndexOf forEach map filter some every reduce reduceRight'
+    )
+
+_STRING_METHODS = (
+    'charAt charCodeAt indexOf lastIndexOf split substring substr slice '
+    'concat toLowerCase toUpperCase toLocaleLowerCase toLocaleUpperCase '
+    'localeCompare match search replace trim trimLeft trimRight quote'
+    )
+
+_STANDARD_PROPERTIES = {
+    'Object': (
+        'getPrototypeOf keys create defineProperty defineProperties '
+        'getOwnPropertyDescriptor getOwnPropertyNames preventExtensions '
+        'isExtensible seal isSealed freeze isFrozen'
+        ),
+    'Object.prototype': (
+        'toString toLocaleString toSource valueOf '
+        'hasOwnProperty isPrototypeOf propertyIsEnumerable '
+        '__defineGetter__ __defineSetter__ __lookupGetter__ '
+        '__lookupSetter__ __iterator__ __noSuchMethod__ watch unwatch'
+        ),
+    'Function.prototype': (
+        'toString toSource apply call bind isGenerator length name'
+        ),
+    # Array and String also have "generic" versions of their methods.
+    'Array': 'isArray ' + _ARRAY_METHODS,
+    'Array.prototype': (
+        'toString toLocaleString toSource length ' + _ARRAY_METHODS
+        ),
+    'String': 'fromCharCode ' + _STRING_METHODS,
+    'String.prototype': (
+        'toString toSource valueOf length anchor big blink bold fixed '
+        'fontcolor fontsize italics link small strike sub sup ' +
+        _STRING_METHODS
+        ),
+    'Number': (
+        'MAX_VALUE MIN_VALUE NaN NEGATIVE_INFINITY POSITIVE_INFINITY'
+        ),
+    'Number.prototype': (
+        'toString toSource valueOf toLocaleString toFixed '
+        'toExponential toPrecision'
+        ),
+    'Boolean.prototype': 'toString toSource valueOf',
+    'Date': 'parse UTC now',
+    'Date.prototype': (
+        'toString toSource valueOf getTime getTimezoneOffset getYear '
+        'getFullYear getUTCFullYear getMonth getUTCMonth getDate '
+        'getUTCDate getDay getUTCDay getHours getUTCHours getMinutes '
+        'getUTCMinutes getSeconds getUTCSeconds getMilliseconds '
+        'getUTCMilliseconds setTime setYear setFullYear setUTCFullYear '
+        'setMonth setUTCMonth setDate setUTCDate setHours setUTCHours '
+        'setMinutes setUTCMinutes setSeconds setUTCSeconds '
+        'setMilliseconds setUTCMilliseconds toUTCString toGMTString '
+        'toLocaleString toLocaleDateString toLocaleTimeString '
+        'toLocaleFormat toDateString toTimeString toISOString toJSON'
+        ),
+    'RegExp': 'multiline',
+    'RegExp.prototype': (
+        'toString toSource exec test compile source global ignoreCase '
+        'multiline sticky lastIndex'
+        ),
+    'Math': (
+        'E LN2 LN10 LOG2E LOG10E PI SQRT1_2 SQRT2 toSource '
+        'abs acos asin atan atan2 ceil cos exp floor log max min pow '
+        'random round sin sqrt tan'
+        ),
+    'JSON': 'parse stringify toSource',
+    'Error.prototype': (
+        'toString toSource message name fileName lineNumber stack'
+        ),
+    'Iterator.prototype': 'next iterator',
+    }
+
+class JsSandbox(object):
+    """
+    A JS runtime and associated functionality capable of securely
+    loading and executing scripts.
+    """
+
+    # Default limits on the nesting depth and total number of values
+    # of structures converted by to_js() and to_python().
+    DEFAULT_MAX_DEPTH = 100
+    DEFAULT_MAX_SIZE = 1000000
+
+    # Default number of values fetched at a time by the iter_*()
+    # methods, and of calls made at a time by map().
+    DEFAULT_CHUNK_SIZE = 1000
+
+    # Default interval, in seconds, at which profile() samples the JS
+    # stack.
+    DEFAULT_PROFILE_INTERVAL = 0.01
+
+    # Rough estimates, in bytes, of the memory taken up by a Python
+    # function exposed to JS (including its JS function object and
+    # Python wrapper), and by any other JS object held by the sandbox.
+    ESTIMATED_FUNCTION_SIZE = 400
+    ESTIMATED_OBJECT_SIZE = 150
+
+    # What is captured whenever a new JS exception is thrown: 'full'
+    # captures both the Python and JS stacks (as py_stack and
+    # js_stack), 'js' only captures the JS stack, and 'none' captures
+    # nothing, in which case errors reported by run_script() have no
+    # traceback. Since JS code may catch the exceptions it throws,
+    # capturing less makes exception-heavy code faster.
+    THROW_CAPTURE_MODES = ('full', 'js', 'none')
+
+    # The number of JS objects with Python private data, other than
+    # bridged functions, that the sandbox remembers (so that reset()
+    # and finish() can disown them) before it checks whether any of
+    # them have been garbage collected.
+    MIN_PRIVATE_OBJECTS_LIMIT = 64
+
+    def __init__(self, fs, watchdog=None, opcb=None,
+                 script_cache=script_cache, watchdog_interval=None,
+                 quota=None, max_bridged_functions=None,
+                 throw_capture='full'):
+        if throw_capture not in self.THROW_CAPTURE_MODES:
+            raise ValueError("Unknown throw capture mode: %r" %
+                             (throw_capture,))
+        rt = pydermonkey.Runtime()
+        cx = rt.new_context()
+        root_proto = cx.new_object()
+        cx.init_standard_classes(root_proto)
+        root = cx.new_object(None, root_proto)
+
+        cx.set_operation_callback(self._opcb)
+        cx.set_throw_hook(self._throwhook)
+        if watchdog is None:
+            watchdog = _get_global_watchdog()
+        watchdog.add_context(cx, watchdog_interval)
+
+        self.fs = fs
+        self.watchdog = watchdog
+        self.watchdog_interval = watchdog_interval
+        self.opcb = opcb
+        self.quota = quota
+        self.max_bridged_functions = max_bridged_functions
+        self.throw_capture = throw_capture
+        self.last_usage = None
+        self.script_cache = script_cache
+        self.rt = rt
+        self.cx = cx
+        self.curr_exc = None
+        self.py_stack = None
+        self.js_stack = None
+        self.__js_depth = 0
+        self.__budget = None
+        self.__profile = None
+        self.__modules = {}
+        self.__bundle = ModuleBundle()
+        self.__py_to_js = collections.OrderedDict()
+        self.__evicted_functions = 0
+        self.__js_calls = 0
+        self.__throws = 0
+        self.__ticks = 0
+        self.__require_hits = 0
+        self.__require_misses = 0
+        self.__require_load_times = Histogram()
+        self.__run_script_times = Histogram()
+        # Callables that are passed the name and value of each timing
+        # as it's observed, e.g. to push it to a metrics system.
+        self.stats_hooks = []
+        self.__bridge = _Bridge(self)
+        self.__type_protos = {}
+        self.__globals = {}
+        # Wrappers are cached so that wrapping the same JS object
+        # repeatedly returns the same wrapper while it's alive.
+        self.__wrappers = weakref.WeakValueDictionary()
+        self.__wrapper_hits = 0
+        self.__wrapper_allocations = 0
+        self.__root_proto = root_proto
+        self.__intrinsics = self.__get_intrinsics(root_proto)
+        self.__helpers = {}
+        self.__module_scopes = {}
+        self.__private_objects = []
+        self.__private_objects_limit = self.MIN_PRIVATE_OBJECTS_LIMIT
+        # The standard objects are snapshotted before JS code is first
+        # run, rather than now, to keep creating sandboxes cheap.
+        self.__builtins_snapshot = None
+        self.__kept_modules = []
+        self.__kept_snapshot = []
+        self.root = self.wrap_jsobject(root, root)
+
+    def __get_intrinsics(self, root_proto):
+        # Keep references to the standard functions we rely on, so
+        # that untrusted JS can't tamper with them later.
+        cx = self.cx
+        intrinsics = {}
+        array = cx.get_property(root_proto, 'Array')
+        array_proto = cx.get_property(array, 'prototype')
+        intrinsics['push'] = cx.get_property(array_proto, 'push')
+        obj = cx.get_property(root_proto, 'Object')
+        obj_proto = cx.get_property(obj, 'prototype')
+        intrinsics['toString'] = cx.get_property(obj_proto, 'toString')
+        intrinsics['hasOwnProperty'] = cx.get_property(obj_proto,
+                                                       'hasOwnProperty')
+        iterator = cx.get_property(root_proto, 'Iterator')
+        if isinstance(iterator, pydermonkey.Function):
+            intrinsics['Iterator'] = iterator
+            iterator_proto = cx.get_property(iterator, 'prototype')
+            intrinsics['Iterator.prototype'] = iterator_proto
+            intrinsics['next'] = cx.get_property(iterator_proto, 'next')
+            intrinsics['StopIteration'] = cx.get_property(root_proto,
+                                                          'StopIteration')
+        json = cx.get_property(root_proto, 'JSON')
+        if isinstance(json, pydermonkey.Object):
+            intrinsics['JSON'] = json
+            intrinsics['parse'] = cx.get_property(json, 'parse')
+            intrinsics['stringify'] = cx.get_property(json, 'stringify')
+        lookup_getter = cx.get_property(obj_proto, '__lookupGetter__')
+        if isinstance(lookup_getter, pydermonkey.Function):
+            intrinsics['lookupGetter'] = lookup_getter
+        function = cx.get_property(root_proto, 'Function')
+        function_proto = cx.get_property(function, 'prototype')
+        intrinsics['apply'] = cx.get_property(function_proto, 'apply')
+        intrinsics['call'] = cx.get_property(function_proto, 'call')
+        bind = cx.get_property(function_proto, 'bind')
+        if isinstance(bind, pydermonkey.Function):
+            intrinsics['bind'] = bind
+        regexp = cx.get_property(root_proto, 'RegExp')
+        regexp_proto = cx.get_property(regexp, 'prototype')
+        intrinsics['exec'] = cx.get_property(regexp_proto, 'exec')
+        get_names = cx.get_property(obj, 'getOwnPropertyNames')
+        if isinstance(get_names, pydermonkey.Function):
+            intrinsics['Object'] = obj
+            intrinsics['getOwnPropertyNames'] = get_names
+        return intrinsics
+
+    def __get_standard_holders(self):
+        # Returns a list of (name, object) tuples of the root prototype
+        # and the standard objects that hold standard properties.
+        cx = self.cx
+        holders = [('', self.__root_proto)]
+        for name in _STANDARD_GLOBALS:
+            value = cx.get_property(self.__root_proto, name)
+            if isinstance(value, pydermonkey.Object):
+                holders.append((name, value))
+                proto = cx.get_property(value, 'prototype')
+                if isinstance(proto, pydermonkey.Object):
+                    holders.append((name + '.prototype', proto))
+        return holders
+
+    def __get_own_names(self, obj):
+        # Returns the names of all the given object's own properties,
+        # including non-enumerable ones, or just its enumerable ones
+        # if Object.getOwnPropertyNames() isn't available.
+        cx = self.cx
+        get_names = self.__intrinsics.get('getOwnPropertyNames')
+        if get_names is None:
+            return cx.enumerate(obj)
+        names = cx.call_function(self.__intrinsics['Object'], get_names,
+                                 (obj,))
+        return [cx.get_property(names, i)
+                for i in range(cx.get_property(names, 'length'))]
+
+    def __snapshot_object(self, obj, names):
+        # Returns a list describing the given object's own properties
+        # and the values of those and of the given properties, or None
+        # if any of them is a getter, which may have been defined by
+        # untrusted JS. The enumerable properties of functions among
+        # the values are described too, since JS code could use them
+        # to pass data along.
+        cx = self.cx
+        own = sorted(self.__get_own_names(obj))
+        lookup_getter = self.__intrinsics.get('lookupGetter')
+        snapshot = [own]
+        for name in sorted(set(names).union(own)):
+            if (lookup_getter is not None and
+                cx.call_function(obj, lookup_getter, (name,)) is not
+                pydermonkey.undefined):
+                return None
+            value = cx.get_property(obj, name)
+            if value != value:
+                # NaN isn't equal to itself.
+                value = 'NaN'
+            if isinstance(value, pydermonkey.Function):
+                snapshot.append((name, value, sorted(cx.enumerate(value))))
+            else:
+                snapshot.append((name, value))
+        return snapshot
+
+    def __snapshot_builtins(self):
+        # The RegExp statics (e.g. RegExp.lastMatch) change whenever a
+        # regular expression is used, so they're cleared first.
+        self.__call_helper('clear_regexp_statics', self._get_invoke(),
+                           self.__intrinsics['exec'])
+        snapshot = []
+        for name, holder in self.__get_standard_holders():
+            names = ['prototype', 'constructor', '__proto__']
+            if name:
+                names.extend(_STANDARD_PROPERTIES.get(name, '').split())
+            else:
+                names.extend(_STANDARD_GLOBALS)
+            snapshot.append((name, self.__snapshot_object(holder, names)))
+        return snapshot
+
+    def snapshot_builtins(self):
+        """
+        Records the current state of the standard JS objects, such as
+        Array.prototype, as the state that reset() expects to find
+        them in. This is done automatically the first time JS code is
+        run, but should be called again if trusted JS code that adds
+        to them, e.g. to polyfill missing methods, is run afterwards.
+        """
+
+        self.__builtins_snapshot = self.__snapshot_builtins()
+
+    def set_globals(self, **globals):
+        """
+        Sets the global properties for the root object and all global
+        scopes (e.g., SecurableModules).  This should be called before
+        any scripts are executed.
+        """
+
+        self.__globals.update(globals)
+        self._install_globals(self.root)
+        for scope in self.__module_scopes.values():
+            self._install_globals(self.wrap_jsobject(scope))
+
+    def reset(self, keep_modules=()):
+        """
+        Discards all the state that JS code and the sandbox's users
+        have added to the sandbox, so that it can be reused as if it
+        were new, without the cost of creating a new JS runtime. The
+        modules with the given paths, if they've already been
+        required, are kept, along with their exports.
+
+        After a reset, the sandbox has a new, empty root object, no
+        globals (they need to be set again via set_globals()), no
+        modules other than the kept ones, and no exception state. Its
+        Python functions and objects exposed to JS, including
+        functions evicted due to max_bridged_functions, are disowned,
+        so that any JS references to them that survive the reset are
+        inert. The kept modules' scopes lose their globals, and gain
+        a new require() function along with any globals set
+        afterwards.
+
+        The standard JS objects, such as Array.prototype, are shared
+        by the old and new root objects, so the reset is refused if
+        JS code has tampered with their properties, or with the kept
+        modules' exports; in that case, False is returned and the
+        sandbox should be cleaned up via finish() instead. Otherwise,
+        True is returned. See snapshot_builtins() for when their
+        expected state is recorded.
+
+        The check has limits: the internal state of standard objects
+        (e.g. the [[Prototype]] of a Date instance) isn't covered, and
+        where Object.getOwnPropertyNames() isn't available, only the
+        standard properties listed in _STANDARD_PROPERTIES, and any
+        enumerable ones, are checked, so JS code that overwrites some
+        other non-enumerable standard property goes unnoticed. A
+        sandbox that runs code which must not be able to affect code
+        run after it under any circumstances should be finished
+        rather than reset.
+
+        Kept modules must be trusted, since anything they reference
+        survives the reset, and should have been required before any
+        untrusted JS code was run, e.g. by a JsSandboxPool's 'setup'.
+        """
+
+        if self.__js_depth:
+            raise RuntimeError("Can't reset a sandbox while it's running "
+                               "JS code")
+        if self.__builtins_snapshot is None:
+            # No JS code has been run yet.
+            self.__builtins_snapshot = self.__snapshot_builtins()
+        elif (self.__snapshot_builtins() != self.__builtins_snapshot or
+              self.__snapshot_kept_modules() != self.__kept_snapshot):
+            return False
+
+        cx = self.cx
+        kept = {}
+        for path in keep_modules:
+            filename = (self.__bundle.find_module('<string>', path) or
+                        self.fs.find_module('<string>', path))
+            if filename in self.__module_scopes:
+                kept[filename] = self.__module_scopes[filename]
+
+        calls = self.__bridge.calls
+        self.__disown_all()
+        self.__bridge = _Bridge(self)
+        self.__bridge.calls = calls
+        self.__type_protos.clear()
+        self.__wrappers.clear()
+
+        for scope in kept.values():
+            for name in self.__globals:
+                cx.define_property(scope, name, pydermonkey.undefined)
+        self.__globals.clear()
+        for scope in kept.values():
+            self._install_globals(self.wrap_jsobject(scope))
+        self.__modules = dict((filename, self.__modules[filename])
+                              for filename in kept)
+        self.__module_scopes = kept
+        self.__kept_modules = sorted(kept)
+        self.__kept_snapshot = self.__snapshot_kept_modules()
+
+        self.curr_exc = None
+        self.py_stack = None
+        self.js_stack = None
+        self.last_usage = None
+        self.__call_helper('clear_regexp_statics', self._get_invoke(),
+                           self.__intrinsics['exec'])
+        root = cx.new_object(None, self.__root_proto)
+        self.root = self.wrap_jsobject(root, root)
+        return True
+
+    def __snapshot_kept_modules(self):
+        return [(filename,
+                 self.__snapshot_object(
+                     self.__modules[filename].wrapped_jsobject, ()))
+                for filename in self.__kept_modules]
+
+    def __call_helper(self, name, *args):
+        helper = self._get_helper(name)
+        return self.cx.call_function(helper, helper, args)
+
+    def _get_invoke(self):
+        # Returns a JS function that's passed a function, a 'this'
+        # object and an array of arguments, and calls the function
+        # like Function.prototype.apply() would, without looking up
+        # any properties that JS code could have tampered with.
+        intrinsics = self.__intrinsics
+        invoke = intrinsics.get('invoke')
+        if invoke is None:
+            if 'bind' in intrinsics:
+                # Function.prototype.call, bound to be called on apply.
+                invoke = self.cx.call_function(intrinsics['call'],
+                                               intrinsics['bind'],
+                                               (intrinsics['apply'],))
+            else:
+                key = '__pydertron_%s' % os.urandom(8).encode('hex')
+                helper = self._get_helper('make_invoke')
+                invoke = self.cx.call_function(helper, helper,
+                                               (intrinsics['apply'], key))
+            intrinsics['invoke'] = invoke
+        return invoke
+
+    def __track_private_object(self, jsobject):
+        # Remembers a JS object whose private data is a Python object,
+        # so that it can be disowned by reset() and finish(). Weak
+        # references are used where pydermonkey supports them, so
+        # that the object can still be garbage collected.
+        objects = self.__private_objects
+        try:
+            objects.append(weakref.ref(jsobject))
+        except TypeError:
+            objects.append(lambda: jsobject)
+        if len(objects) > self.__private_objects_limit:
+            objects[:] = [ref for ref in objects if ref() is not None]
+            self.__private_objects_limit = max(
+                self.MIN_PRIVATE_OBJECTS_LIMIT,
+                2 * len(objects)
+                )
+
+    def __disown_all(self):
+        # Clears the private data of every JS object that refers to a
+        # Python object exposed by the sandbox, and of the bridge used
+        # by the wrappers of exposed functions.
+        cx = self.cx
+        for jsobj in self.__py_to_js.values():
+            cx.clear_object_private(jsobj)
+        self.__py_to_js.clear()
+        for ref in self.__private_objects:
+            jsobj = ref()
+            if jsobj is not None:
+                cx.clear_object_private(jsobj)
+        del self.__private_objects[:]
+        self.__private_objects_limit = self.MIN_PRIVATE_OBJECTS_LIMIT
+        self.__bridge.clear()
+
+    def finish(self):
+        """
+        Cleans up all resources used by the sandbox, breaking any reference
+        cycles created due to issue #2 in pydermonkey:
+
+        http://code.google.com/p/pydermonkey/issues/detail?id=2
+        """
+
+        self.__disown_all()
+        if self.script_cache is not None:
+            self.script_cache.purge(self.rt)
+        self.watchdog.remove_context(self.cx)
         del self.__py_to_js
+        del self.__private_objects
         del self.__type_protos
+        del self.__intrinsics
+        del self.__helpers
+        del self.__wrappers
+        del self.__bundle
+        del self.__module_scopes
+        del self.__builtins_snapshot
+        del self.__kept_modules
+        del self.__kept_snapshot
         del self.curr_exc
         del self.py_stack
         del self.js_stack
@@ -348,19 +1825,96 @@ class JsSandbox(object):
     def _opcb(self, cx):
         # Note that if a keyboard interrupt was triggered,
         # it'll get raised here automatically.
+        self.__ticks += 1
+        if self.__budget is not None:
+            self.__budget[2] += 1
+            self.__check_budget()
+        if self.__profile is not None:
+            self.__profile.add_sample(cx.get_stack())
         if self.opcb:
             self.opcb()
 
+    @contextlib.contextmanager
+    def profile(self, interval=DEFAULT_PROFILE_INTERVAL):
+        """
+        Returns a context manager that profiles the JS code run by the
+        sandbox within its block, yielding a JsProfile that the JS
+        stack is sampled into every 'interval' seconds.
+
+        While profiling, the sandbox's operation callback is triggered
+        at the sampling interval, which also affects the sandbox's
+        'ticks' quota.
+        """
+
+        profile = JsProfile(interval)
+        self.__profile = profile
+        self.watchdog.set_interval(self.cx, interval)
+        try:
+            yield profile
+        finally:
+            self.__profile = None
+            self.watchdog.set_interval(self.cx, self.watchdog_interval)
+
+    def _enter_js(self):
+        # Called whenever Python code is about to call into JS code.
+        self.__js_calls += 1
+        if self.__builtins_snapshot is None:
+            self.__builtins_snapshot = self.__snapshot_builtins()
+        self.__js_depth += 1
+        if self.__js_depth == 1 and self.quota is not None:
+            if self.quota.heap is None:
+                start_rss = None
+            else:
+                start_rss = _get_rss()
+            self.__budget = [time.time(), _thread_cpu_time(), 0, start_rss]
+
+    def _leave_js(self):
+        # Called whenever a call from Python into JS code has finished.
+        self.__js_depth -= 1
+        if self.__js_depth == 0 and self.__budget is not None:
+            self.last_usage = self.__get_usage()
+            self.__budget = None
+
+    def __get_usage(self):
+        start_time, start_cpu_time, ticks, start_rss = self.__budget
+        usage = dict(wall_time = time.time() - start_time,
+                     cpu_time = _thread_cpu_time() - start_cpu_time,
+                     ticks = ticks)
+        if start_rss is not None:
+            usage['heap'] = _get_rss() - start_rss
+        return usage
+
+    def __check_budget(self):
+        quota = self.quota
+        usage = self.__get_usage()
+        for resource in ['wall_time', 'cpu_time', 'ticks', 'heap']:
+            limit = getattr(quota, resource)
+            if limit is not None and usage.get(resource, 0) > limit:
+                self.js_stack = self.cx.get_stack()
+                raise QuotaExceededError(resource, limit, usage,
+                                         self.js_stack)
+
     def _throwhook(self, cx):
+        self.__throws += 1
+        capture = self.throw_capture
+        if capture == 'none':
+            return
         curr_exc = cx.get_pending_exception()
         if self.curr_exc != curr_exc:
             self.curr_exc = curr_exc
-            self.py_stack = traceback.extract_stack()
+            if capture == 'full':
+                self.py_stack = traceback.extract_stack()
             self.js_stack = cx.get_stack()
 
-    def __wrap_pycallable(self, func, pyproto=None):
-        if func in self.__py_to_js:
-            return self.__py_to_js[func]
+    def __wrap_pycallable(self, func, pyproto=None, arity=None):
+        py_to_js = self.__py_to_js
+        if func in py_to_js:
+            jsfunc = py_to_js[func]
+            if self.max_bridged_functions is not None:
+                # Mark the function as the most recently used one.
+                del py_to_js[func]
+                py_to_js[func] = jsfunc
+            return jsfunc
 
         if hasattr(func, '__name__'):
             name = func.__name__
@@ -368,34 +1922,19 @@ class JsSandbox(object):
             name = ""
 
         if pyproto:
-            def wrapper(func_cx, this, args):
-                try:
-                    arglist = []
-                    for arg in args:
-                        arglist.append(self.wrap_jsobject(arg))
-                    instance = func_cx.get_object_private(this)
-                    if instance is None or not isinstance(instance, pyproto):
-                        raise pydermonkey.error("Method type mismatch")
-
-                    # TODO: Fill in extra required params with
-                    # pymonkey.undefined?  or automatically throw an
-                    # exception to calling js code?
-                    return self.wrap_pyobject(func(instance, *arglist))
-                except pydermonkey.error:
-                    raise
-                except Exception:
-                    raise InternalError()
+            wrapper = self.__make_method_wrapper(func, name, pyproto, arity)
         else:
+            bridge = self.__bridge
+
             def wrapper(func_cx, this, args):
+                bridge.calls += 1
                 try:
-                    arglist = []
-                    for arg in args:
-                        arglist.append(self.wrap_jsobject(arg))
+                    arglist = [bridge.wrap(arg) for arg in args]
 
                     # TODO: Fill in extra required params with
                     # pymonkey.undefined?  or automatically throw an
                     # exception to calling js code?
-                    return self.wrap_pyobject(func(*arglist))
+                    return bridge.wrap_result(func(*arglist))
                 except pydermonkey.error:
                     raise
                 except Exception:
@@ -404,49 +1943,122 @@ class JsSandbox(object):
         wrapper.__name__ = name
 
         jsfunc = self.cx.new_function(wrapper, name)
-        self.__py_to_js[func] = jsfunc
+        py_to_js[func] = jsfunc
+        if (self.max_bridged_functions is not None and
+            len(py_to_js) > self.max_bridged_functions):
+            # Forget the least recently used function; it's up to the
+            # JS garbage collector to free it once JS code no longer
+            # references it.
+            evicted = py_to_js.popitem(last=False)[1]
+            self.__track_private_object(evicted)
+            self.__evicted_functions += 1
 
         return jsfunc
 
+    def __make_method_wrapper(self, func, name, pyproto, arity):
+        # Returns a wrapper for the given method that's specialized for
+        # the number of arguments it takes; calls from JS with the wrong
+        # number of arguments raise an error that JS code can catch.
+        if arity is None:
+            arity = (0, None)
+        min_args, max_args = arity
+        arity_error = _describe_arity(name, min_args, max_args)
+        bridge = self.__bridge
+
+        if max_args == 0:
+            def wrapper(func_cx, this, args):
+                bridge.calls += 1
+                try:
+                    if args:
+                        raise pydermonkey.error(arity_error % len(args))
+                    instance = func_cx.get_object_private(this)
+                    if instance is None or not isinstance(instance, pyproto):
+                        raise pydermonkey.error("Method type mismatch")
+                    return bridge.wrap_result(func(instance))
+                except pydermonkey.error:
+                    raise
+                except Exception:
+                    raise InternalError()
+        elif min_args == max_args == 1:
+            def wrapper(func_cx, this, args):
+                bridge.calls += 1
+                try:
+                    if len(args) != 1:
+                        raise pydermonkey.error(arity_error % len(args))
+                    instance = func_cx.get_object_private(this)
+                    if instance is None or not isinstance(instance, pyproto):
+                        raise pydermonkey.error("Method type mismatch")
+                    return bridge.wrap_result(func(instance,
+                                                   bridge.wrap(args[0])))
+                except pydermonkey.error:
+                    raise
+                except Exception:
+                    raise InternalError()
+        elif min_args == max_args == 2:
+            def wrapper(func_cx, this, args):
+                bridge.calls += 1
+                try:
+                    if len(args) != 2:
+                        raise pydermonkey.error(arity_error % len(args))
+                    instance = func_cx.get_object_private(this)
+                    if instance is None or not isinstance(instance, pyproto):
+                        raise pydermonkey.error("Method type mismatch")
+                    return bridge.wrap_result(func(instance,
+                                                   bridge.wrap(args[0]),
+                                                   bridge.wrap(args[1])))
+                except pydermonkey.error:
+                    raise
+                except Exception:
+                    raise InternalError()
+        else:
+            def wrapper(func_cx, this, args):
+                bridge.calls += 1
+                try:
+                    if (len(args) < min_args or
+                        (max_args is not None and len(args) > max_args)):
+                        raise pydermonkey.error(arity_error % len(args))
+                    instance = func_cx.get_object_private(this)
+                    if instance is None or not isinstance(instance, pyproto):
+                        raise pydermonkey.error("Method type mismatch")
+                    arglist = [bridge.wrap(arg) for arg in args]
+                    return bridge.wrap_result(func(instance, *arglist))
+                except pydermonkey.error:
+                    raise
+                except Exception:
+                    raise InternalError()
+        return wrapper
+
     def __wrap_pyinstance(self, value):
         pyproto = type(value)
         if pyproto not in self.__type_protos:
+            info = _get_exposed_class_info(pyproto)
             jsproto = self.cx.new_object()
-            if hasattr(pyproto, '__jsprops__'):
+            if info.properties:
                 define_getter = self.cx.get_property(jsproto,
                                                      '__defineGetter__')
                 define_setter = self.cx.get_property(jsproto,
                                                      '__defineSetter__')
-                for name in pyproto.__jsprops__:
-                    prop = getattr(pyproto, name)
-                    if not type(prop) == property:
-                        raise TypeError("Expected attribute '%s' to "
-                                        "be a property" % name)
-                    getter = None
-                    setter = None
-                    if prop.fget:
-                        getter = self.__wrap_pycallable(prop.fget,
-                                                        pyproto)
-                    if prop.fset:
-                        setter = self.__wrap_pycallable(prop.fset,
-                                                        pyproto)
-                    if getter:
+                for name, fget, fset in info.properties:
+                    if fget:
+                        getter = self.__wrap_pycallable(fget, pyproto,
+                                                        (0, 0))
                         self.cx.call_function(jsproto,
                                               define_getter,
                                               (name, getter))
-                    if setter:
+                    if fset:
+                        setter = self.__wrap_pycallable(fset, pyproto,
+                                                        (1, 1))
                         self.cx.call_function(jsproto,
                                               define_setter,
                                               (name, setter,))
-            for name in dir(pyproto):
-                attr = getattr(pyproto, name)
-                if (isinstance(attr, types.UnboundMethodType) and
-                    hasattr(attr, '__jsexposed__') and
-                    attr.__jsexposed__):
-                    jsmethod = self.__wrap_pycallable(attr, pyproto)
-                    self.cx.define_property(jsproto, name, jsmethod)
+            for name, func, arity in info.methods:
+                method = types.MethodType(func, None, pyproto)
+                jsmethod = self.__wrap_pycallable(method, pyproto, arity)
+                self.cx.define_property(jsproto, name, jsmethod)
             self.__type_protos[pyproto] = jsproto
-        return self.cx.new_object(value, self.__type_protos[pyproto])
+        jsobject = self.cx.new_object(value, self.__type_protos[pyproto])
+        self.__track_private_object(jsobject)
+        return jsobject
 
     def wrap_pyobject(self, value):
         """
@@ -471,6 +2083,8 @@ class JsSandbox(object):
             return self.__wrap_pycallable(value)
         elif isinstance(value, JsExposedObject):
             return self.__wrap_pyinstance(value)
+        elif isinstance(value, (bytearray, array.array, memoryview, buffer)):
+            return self.__wrap_pyinstance(JsBuffer(value))
         else:
             raise TypeError("Can't expose objects of type '%s' to JS." %
                             type_info(value))
@@ -484,14 +2098,24 @@ class JsSandbox(object):
         returned, since no wrapping is needed.
         """
 
+        if not isinstance(jsvalue, pydermonkey.Object):
+            # It's a primitive value.
+            return jsvalue
+
         if this is None:
             this = self.root.wrapped_jsobject
+        key = (jsvalue, this)
+        wrapper = self.__wrappers.get(key)
+        if wrapper is not None:
+            self.__wrapper_hits += 1
+            return wrapper
+
         if isinstance(jsvalue, pydermonkey.Function):
             if jsvalue.is_python:
                 # It's a Python function, just unwrap it.
                 return self.cx.get_object_private(jsvalue).wrapped_pyobject
-            return SafeJsFunctionWrapper(self, jsvalue, this)
-        elif isinstance(jsvalue, pydermonkey.Object):
+            wrapper = SafeJsFunctionWrapper(self, jsvalue, this)
+        else:
             # It's a wrapped Python object instance, just unwrap it.
             instance = self.cx.get_object_private(jsvalue)
             if instance:
@@ -499,71 +2123,638 @@ class JsSandbox(object):
                     raise AssertionError("Object private is not of type "
                                          "JsExposedObject")
                 return instance
-            else:
-                return SafeJsObjectWrapper(self, jsvalue, this)
-        else:
-            # It's a primitive value.
-            return jsvalue
+            wrapper = SafeJsObjectWrapper(self, jsvalue, this)
+        self.__wrappers[key] = wrapper
+        self.__wrapper_allocations += 1
+        return wrapper
 
-    def new_array(self, *contents):
+    def _get_helper(self, name):
+        helper = self.__helpers.get(name)
+        if helper is None:
+            scope = self.cx.new_object(None, self.__root_proto)
+            helper = self.cx.evaluate_script(scope, _JS_HELPERS[name],
+                                             '<pydertron>', 1)
+            self.__helpers[name] = helper
+        return helper
+
+    def call_many(self, jsfunction, args_list, deep=False):
         """
-        Creates a new JavaScript array with the given contents and
-        returns a wrapper for it.
+        Calls the given JS function or SafeJsFunctionWrapper once for
+        each sequence of arguments in the given list, returning a list
+        of the results. All the calls are made by a single loop in JS,
+        rather than crossing from Python into JS for each one.
+
+        Arguments are converted as per to_js(). Results are wrapped as
+        usual, or converted to plain Python data as per to_python() if
+        'deep' is true. If any of the calls throws, the exception is
+        raised and no results are returned.
         """
 
-        array = self.wrap_jsobject(self.cx.new_array_object())
-        for item in contents:
-            array.push(item)
-        return array
+        if isinstance(jsfunction, SafeJsFunctionWrapper):
+            this = jsfunction._this
+        else:
+            this = self.root.wrapped_jsobject
+        jsfunction = self._unwrap_jsobject(jsfunction)
+        if not isinstance(jsfunction, pydermonkey.Function):
+            raise TypeError("'%s' object is not a JS function" %
+                            type(jsfunction).__name__)
+        return self._call_many(jsfunction, this, args_list, deep)
 
-    def new_object(self, **contents):
+    def map(self, jsfunction, args_iterable, chunk_size=DEFAULT_CHUNK_SIZE,
+            deep=False):
         """
-        Creates a new JavaScript object with the given properties and
-        returns a wrapper for it.
+        Like call_many(), but returns a generator that makes the calls
+        in chunks of 'chunk_size' sequences of arguments from the given
+        iterable, yielding their results as each chunk finishes.
         """
 
-        obj = self.wrap_jsobject(self.cx.new_object())
-        for name in contents:
-            obj[name] = contents[name]
-        return obj
+        chunk = []
+        for args in args_iterable:
+            chunk.append(args)
+            if len(chunk) >= chunk_size:
+                for result in self.call_many(jsfunction, chunk, deep):
+                    yield result
+                chunk = []
+        if chunk:
+            for result in self.call_many(jsfunction, chunk, deep):
+                yield result
 
-    def get_calling_script(self):
-        """
-        Returns the filename of the current stack's most recent
-        JavaScript caller.
-        """
+    def _call_many(self, jsfunction, this, args_list, deep):
+        cx = self.cx
+        args_array = self.to_js([list(args) for args in args_list])
+        helper = self._get_helper('call_many')
+        invoke = self._get_invoke()
+        self._enter_js()
+        try:
+            results = cx.call_function(jsfunction, helper,
+                                       (jsfunction, this,
+                                        args_array.wrapped_jsobject,
+                                        invoke))
+        finally:
+            self._leave_js()
+        if deep:
+            return self.to_python(results)
+        return [self.wrap_jsobject(cx.get_property(results, i), jsfunction)
+                for i in range(cx.get_property(results, 'length'))]
 
-        frame = self.cx.get_stack()['caller']
-        curr_script = None
-        while frame and curr_script is None:
-            if frame['function'] and frame['function'].filename:
-                curr_script = frame['function'].filename
-            elif frame['script']:
-                curr_script = frame['script'].filename
-            frame = frame['caller']
+    def _iter_key_chunks(self, jsobject, chunk_size):
+        import json
 
-        if curr_script is None:
-            raise RuntimeError("Can't find calling script")
-        return curr_script
+        cx = self.cx
+        intrinsics = self.__intrinsics
+        if not ('stringify' in intrinsics and 'Iterator' in intrinsics):
+            self._enter_js()
+            try:
+                names = cx.enumerate(jsobject)
+            finally:
+                self._leave_js()
+            for start in xrange(0, len(names), chunk_size):
+                yield list(names[start:start + chunk_size])
+            return
 
-    def _install_globals(self, object):
-        for name in self.__globals:
-            object[name] = self.__globals[name]
-        object['require'] = self._require
+        key_iterator = self._get_helper('key_iterator')
+        self._enter_js()
+        try:
+            iterator = cx.call_function(jsobject, key_iterator,
+                                        (intrinsics['Iterator'], jsobject))
+            if (isinstance(iterator, pydermonkey.Object) and
+                cx.get_property(iterator, '__proto__') ==
+                intrinsics['Iterator.prototype']):
+                next_key = intrinsics['next']
+            else:
+                # The object has its own __iterator__(), whose
+                # iterator's next() is up to JS code anyway.
+                next_key = cx.get_property(iterator, 'next')
+        finally:
+            self._leave_js()
+        next_keys = self._get_helper('next_keys')
+        invoke = self._get_invoke()
+        done = False
+        while not done:
+            self._enter_js()
+            try:
+                text = cx.call_function(jsobject, next_keys,
+                                        (iterator, next_key, jsobject,
+                                         chunk_size, invoke,
+                                         intrinsics['hasOwnProperty'],
+                                         intrinsics['StopIteration'],
+                                         intrinsics['stringify']))
+            finally:
+                self._leave_js()
+            done, names = json.loads(text)
+            if names:
+                yield names
 
-    @jsexposed(name='require')
-    def _require(self, path):
-        """
-        Implementation for the global require() function, implemented
-        as per the CommonJS SecurableModule specification:
+    def _get_many(self, jsobject, names, deep, max_depth=DEFAULT_MAX_DEPTH,
+                  max_size=DEFAULT_MAX_SIZE):
+        # Reading the properties may run getters and toJSON() methods,
+        # so it's subject to the sandbox's quota.
+        self._enter_js()
+        try:
+            return self.__get_many(jsobject, list(names), deep, max_depth,
+                                   max_size)
+        finally:
+            self._leave_js()
 
-        http://wiki.commonjs.org/wiki/CommonJS/Modules/SecurableModules
-        """
+    def __get_many(self, jsobject, names, deep, max_depth, max_size):
+        import json
 
-        filename = self.fs.find_module(self.get_calling_script(), path)
-        if not filename:
-            raise pydermonkey.error('Module not found: %s' % path)
-        if not filename in self.__modules:
+        cx = self.cx
+        if 'stringify' in self.__intrinsics:
+            helper = self._get_helper('get_many')
+            result = cx.call_function(jsobject, helper,
+                                      (jsobject, json.dumps(names),
+                                       self.__intrinsics['parse'],
+                                       self.__intrinsics['stringify']))
+            text = cx.get_property(result, 0)
+            objects = cx.get_property(result, 1)
+            values = json.loads(text)
+            if not (isinstance(values, list) and
+                    len(values) == len(names) and
+                    isinstance(objects, pydermonkey.Object)):
+                # JS code has tampered with array indexes, e.g. via
+                # a setter on Array.prototype.
+                raise pydermonkey.error("Unexpected helper result")
+            count = values.count(0)
+            if deep:
+                # The objects are converted together, so the limits
+                # apply to all of them at once.
+                objects = self.to_python(objects, max_depth + 1,
+                                         max_size + 1)
+            elif cx.get_property(objects, 'length') == count:
+                objects = [self.wrap_jsobject(cx.get_property(objects, i),
+                                              jsobject)
+                           for i in range(count)]
+            if not (isinstance(objects, list) and len(objects) == count):
+                raise pydermonkey.error("Unexpected helper result")
+            objects.reverse()
+            for i in range(len(values)):
+                if values[i] == 0:
+                    values[i] = objects.pop()
+                elif isinstance(values[i], basestring):
+                    values[i] = float(values[i])
+                elif not values[i]:
+                    if deep:
+                        values[i] = None
+                    else:
+                        values[i] = pydermonkey.undefined
+                else:
+                    values[i] = values[i][0]
+            return values
+
+        values = [cx.get_property(jsobject, name) for name in names]
+        if deep:
+            return [self.to_python(value, max_depth, max_size)
+                    for value in values]
+        return [self.wrap_jsobject(value, jsobject) for value in values]
+
+    def _unwrap_jsobject(self, value):
+        if isinstance(value, SafeJsObjectWrapper):
+            value = value.wrapped_jsobject
+        if not isinstance(value, pydermonkey.Object):
+            raise TypeError("'%s' object is not a JS object" %
+                            type(value).__name__)
+        return value
+
+    def get_many(self, jsobject, names, deep=False,
+                 max_depth=DEFAULT_MAX_DEPTH, max_size=DEFAULT_MAX_SIZE):
+        """
+        Returns a list of the values of the given properties of the
+        given JS object or SafeJsObjectWrapper, read in a single pass.
+        Primitive values are returned as-is; other values are wrapped
+        as usual, or converted to plain Python data as per to_python()
+        if 'deep' is true, within the limits given by 'max_depth' and
+        'max_size'. Numbers are returned exactly, including NaN, the
+        infinities and -0.
+
+        These helpers live on the sandbox rather than on the wrappers,
+        so that they never hide JS properties of the same name.
+        """
+
+        return self._get_many(self._unwrap_jsobject(jsobject), names, deep,
+                              max_depth, max_size)
+
+    def items(self, jsobject, deep=False):
+        """
+        Returns a list of (name, value) tuples for all the enumerable
+        properties of the given JS object or SafeJsObjectWrapper; see
+        get_many() for what 'deep' means.
+        """
+
+        jsobject = self._unwrap_jsobject(jsobject)
+        names = list(self.cx.enumerate(jsobject))
+        return zip(names, self._get_many(jsobject, names, deep))
+
+    def snapshot(self, jsobject, deep=True):
+        """
+        Returns a read-only dictionary of the enumerable properties of
+        the given JS object or SafeJsObjectWrapper. If 'deep' is true,
+        nested values are also converted to read-only dictionaries and
+        tuples.
+        """
+
+        items = self.items(jsobject, deep)
+        if deep:
+            items = [(name, _freeze(value)) for name, value in items]
+        return FrozenDict(items)
+
+    def __get_length(self, jsobject):
+        # Returns the length of the given JS array, which JS code
+        # controls, so it has to be validated.
+        length = self.cx.get_property(jsobject, 'length')
+        if (isinstance(length, bool) or
+            not isinstance(length, (int, long, float)) or
+            not 0 <= length <= _MAX_ARRAY_LENGTH or
+            length != int(length)):
+            raise TypeError("JS object has no valid array length")
+        return int(length)
+
+    def iter_values(self, jsobject, chunk_size=DEFAULT_CHUNK_SIZE,
+                    deep=False):
+        """
+        Returns a generator over the values of the elements of the
+        given JS array or its SafeJsObjectWrapper, from index 0 up to
+        its length when iteration starts. Values are fetched lazily,
+        'chunk_size' elements at a time, as per get_many().
+
+        A TypeError is raised if the object's length isn't a valid JS
+        array length.
+        """
+
+        jsobject = self._unwrap_jsobject(jsobject)
+        length = self.__get_length(jsobject)
+        start = 0
+        while start < length:
+            end = min(start + chunk_size, length)
+            for value in self._get_many(jsobject, range(start, end), deep):
+                yield value
+            start = end
+
+    def iter_keys(self, jsobject, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Returns a generator over the names of the own enumerable
+        properties of the given JS object or SafeJsObjectWrapper,
+        which are fetched lazily, 'chunk_size' names at a time, rather
+        than all at once as with iter().
+        """
+
+        jsobject = self._unwrap_jsobject(jsobject)
+        for names in self._iter_key_chunks(jsobject, chunk_size):
+            for name in names:
+                yield name
+
+    def iter_items(self, jsobject, chunk_size=DEFAULT_CHUNK_SIZE,
+                   deep=False):
+        """
+        Returns a generator of (name, value) tuples for the own
+        enumerable properties of the given JS object or
+        SafeJsObjectWrapper, which are fetched lazily, 'chunk_size'
+        properties at a time; see get_many() for what 'deep' means.
+        """
+
+        jsobject = self._unwrap_jsobject(jsobject)
+        for names in self._iter_key_chunks(jsobject, chunk_size):
+            for item in zip(names, self._get_many(jsobject, names, deep)):
+                yield item
+
+    def bridge_stats(self):
+        """
+        Returns a dictionary with the number of Python functions,
+        Python type prototypes and modules that the sandbox holds JS
+        counterparts for, along with a rough estimate of the memory,
+        in bytes, that they take up.
+        """
+
+        functions = len(self.__py_to_js)
+        type_protos = len(self.__type_protos)
+        modules = len(self.__modules)
+        estimated_size = (sys.getsizeof(self.__py_to_js) +
+                          sys.getsizeof(self.__type_protos) +
+                          sys.getsizeof(self.__modules) +
+                          functions * self.ESTIMATED_FUNCTION_SIZE +
+                          (type_protos + modules) *
+                          self.ESTIMATED_OBJECT_SIZE)
+        return dict(functions = functions,
+                    evicted_functions = self.__evicted_functions,
+                    type_protos = type_protos,
+                    modules = modules,
+                    estimated_size = estimated_size)
+
+    def wrapper_stats(self):
+        """
+        Returns a dictionary of statistics about the wrappers created
+        by wrap_jsobject(): the number of times an existing wrapper was
+        reused, the number of wrappers allocated, and the number of
+        wrappers that are currently alive.
+        """
+
+        return dict(hits = self.__wrapper_hits,
+                    allocations = self.__wrapper_allocations,
+                    live = len(self.__wrappers))
+
+    def gc(self):
+        """
+        Runs the JS garbage collector on the sandbox's runtime. This is
+        best done between jobs, or while the sandbox is idle, so that
+        collection doesn't happen in the middle of a job instead.
+        """
+
+        self.cx.gc()
+
+    def memory_stats(self):
+        """
+        Returns a dictionary with the process's resident memory in
+        bytes as 'rss' (None where it can't be measured), pydermonkey's
+        debugging information about its JS runtimes as 'debug_info',
+        the sandbox's bridge_stats() as 'bridge', and the number of
+        live wrappers as 'wrappers'.
+        """
+
+        if _get_rss is None:
+            rss = None
+        else:
+            rss = _get_rss()
+        return dict(rss = rss,
+                    debug_info = pydermonkey.get_debug_info(),
+                    bridge = self.bridge_stats(),
+                    wrappers = len(self.__wrappers))
+
+    def __observe(self, histogram, name, value):
+        histogram.observe(value)
+        for hook in self.stats_hooks:
+            hook(name, value)
+
+    def stats(self):
+        """
+        Returns a dictionary of the sandbox's metrics, with 'counters',
+        'gauges' and 'histograms' dictionaries keyed by metric name;
+        histograms are given as per Histogram.to_dict(). The result
+        can be formatted for Prometheus via format_prometheus().
+
+        Counters include the number of calls from Python into JS and
+        from JS into Python, thrown JS exceptions and operation
+        callback ticks. Timings are in seconds.
+        """
+
+        bridge_stats = self.bridge_stats()
+        return dict(
+            counters = dict(
+                js_calls = self.__js_calls,
+                py_calls = self.__bridge.calls,
+                throws = self.__throws,
+                ticks = self.__ticks,
+                wrapper_hits = self.__wrapper_hits,
+                wrapper_allocations = self.__wrapper_allocations,
+                evicted_functions = self.__evicted_functions,
+                require_hits = self.__require_hits,
+                require_misses = self.__require_misses
+                ),
+            gauges = dict(
+                live_wrappers = len(self.__wrappers),
+                functions = bridge_stats['functions'],
+                type_protos = bridge_stats['type_protos'],
+                modules = bridge_stats['modules'],
+                estimated_bridge_size = bridge_stats['estimated_size']
+                ),
+            histograms = dict(
+                require_load_seconds = self.__require_load_times.to_dict(),
+                run_script_seconds = self.__run_script_times.to_dict()
+                )
+            )
+
+    def to_js(self, value, max_depth=DEFAULT_MAX_DEPTH,
+              max_size=DEFAULT_MAX_SIZE):
+        """
+        Converts the given Python value, which may be an arbitrarily
+        nested structure of lists, tuples and dictionaries, into a new
+        JS value and returns a wrapper for it. Anything other than
+        containers and primitives is wrapped as per wrap_pyobject().
+
+        Shared and cyclic references are preserved. A ValueError is
+        raised if the value is nested more than 'max_depth' levels
+        deep or consists of more than 'max_size' values.
+        """
+
+        import json
+
+        plain = _check_tree(value, max_depth, max_size)
+        if plain and 'parse' in self.__intrinsics:
+            try:
+                text = json.dumps(value)
+            except (TypeError, ValueError, UnicodeDecodeError):
+                pass
+            else:
+                return self.wrap_jsobject(
+                    self.cx.call_function(self.__intrinsics['JSON'],
+                                          self.__intrinsics['parse'],
+                                          (text,))
+                    )
+        return self.wrap_jsobject(self.__to_js(value, {}))
+
+    def __to_js(self, value, memo):
+        cx = self.cx
+        if isinstance(value, (list, tuple)):
+            if id(value) in memo:
+                return memo[id(value)]
+            array = cx.new_array_object()
+            memo[id(value)] = array
+            push = self.__intrinsics['push']
+            for item in value:
+                cx.call_function(array, push, (self.__to_js(item, memo),))
+            return array
+        elif isinstance(value, dict):
+            if id(value) in memo:
+                return memo[id(value)]
+            obj = cx.new_object()
+            memo[id(value)] = obj
+            for name in value:
+                cx.define_property(obj, name, self.__to_js(value[name], memo))
+            return obj
+        else:
+            return self.wrap_pyobject(value)
+
+    def to_python(self, value, max_depth=DEFAULT_MAX_DEPTH,
+                  max_size=DEFAULT_MAX_SIZE):
+        """
+        Converts the given JS value or SafeJsObjectWrapper into plain
+        Python data, in the same way as JSON.stringify() would: arrays
+        become lists and other objects become dictionaries of their
+        enumerable properties, while functions and undefined values are
+        omitted from objects and become None in arrays.
+
+        Shared and cyclic references are preserved. A ValueError is
+        raised if the value is nested more than 'max_depth' levels
+        deep or consists of more than 'max_size' values; the limits
+        are enforced as the value is converted, so conversion stops
+        as soon as one is exceeded. Since conversion may run JS code,
+        such as getters, it's also subject to the sandbox's quota.
+        """
+
+        if isinstance(value, SafeJsObjectWrapper):
+            value = value.wrapped_jsobject
+        if not isinstance(value, pydermonkey.Object):
+            if value is pydermonkey.undefined:
+                return None
+            return value
+        self._enter_js()
+        try:
+            return self.__convert_to_python(value, max_depth, max_size)
+        finally:
+            self._leave_js()
+
+    def __convert_to_python(self, value, max_depth, max_size):
+        import json
+
+        if 'stringify' in self.__intrinsics:
+            helper = self._get_helper('bounded_stringify')
+            try:
+                text = self.cx.call_function(helper, helper,
+                                             (value,
+                                              self.__intrinsics['stringify'],
+                                              max_size))
+            except pydermonkey.error:
+                # The value is most likely cyclic, or too deeply nested
+                # for JSON.stringify().
+                pass
+            else:
+                if text is pydermonkey.undefined:
+                    return None
+                if text is None:
+                    raise ValueError("Value consists of more than %d "
+                                     "items" % max_size)
+                result = json.loads(text)
+                _check_tree(result, max_depth, max_size)
+                return result
+        return self.__to_python(value, {}, [0], 0, max_depth, max_size)
+
+    def __to_python(self, value, memo, count, depth, max_depth, max_size):
+        if not isinstance(value, pydermonkey.Object):
+            if value is pydermonkey.undefined:
+                return None
+            return value
+        if value in memo:
+            return memo[value]
+        if depth >= max_depth:
+            raise ValueError("Value is nested more than %d levels deep" %
+                             max_depth)
+
+        # Values are counted before they're converted, so that
+        # conversion stops as soon as the limit is exceeded.
+        too_big = "Value consists of more than %d items" % max_size
+        cx = self.cx
+        kind = cx.call_function(value, self.__intrinsics['toString'], ())
+        if kind == '[object Array]':
+            length = cx.get_property(value, 'length')
+            if not (isinstance(length, (int, long, float)) and
+                    0 <= length <= _MAX_ARRAY_LENGTH):
+                raise ValueError("Invalid array length")
+            count[0] += int(length)
+            if count[0] > max_size:
+                raise ValueError(too_big)
+            result = []
+            memo[value] = result
+            for i in xrange(int(length)):
+                item = cx.get_property(value, i)
+                if isinstance(item, pydermonkey.Function):
+                    item = None
+                result.append(self.__to_python(item, memo, count, depth + 1,
+                                               max_depth, max_size))
+        else:
+            result = {}
+            memo[value] = result
+            for name in cx.enumerate(value):
+                item = cx.get_property(value, name)
+                if (item is pydermonkey.undefined or
+                    isinstance(item, pydermonkey.Function)):
+                    continue
+                count[0] += 1
+                if count[0] > max_size:
+                    raise ValueError(too_big)
+                result[name] = self.__to_python(item, memo, count, depth + 1,
+                                                max_depth, max_size)
+        return result
+
+    def new_array(self, *contents):
+        """
+        Creates a new JavaScript array with the given contents and
+        returns a wrapper for it.
+        """
+
+        array = self.wrap_jsobject(self.cx.new_array_object())
+        for item in contents:
+            array.push(item)
+        return array
+
+    def new_object(self, **contents):
+        """
+        Creates a new JavaScript object with the given properties and
+        returns a wrapper for it.
+        """
+
+        obj = self.wrap_jsobject(self.cx.new_object())
+        for name in contents:
+            obj[name] = contents[name]
+        return obj
+
+    def get_calling_script(self):
+        """
+        Returns the filename of the current stack's most recent
+        JavaScript caller.
+        """
+
+        frame = self.cx.get_stack()['caller']
+        curr_script = None
+        while frame and curr_script is None:
+            if frame['function'] and frame['function'].filename:
+                curr_script = frame['function'].filename
+            elif frame['script']:
+                curr_script = frame['script'].filename
+            frame = frame['caller']
+
+        if curr_script is None:
+            raise RuntimeError("Can't find calling script")
+        return curr_script
+
+    def _install_globals(self, object):
+        for name in self.__globals:
+            object[name] = self.__globals[name]
+        object['require'] = self._require
+
+    def _evaluate(self, obj, contents, filename, lineno):
+        if self.script_cache is None:
+            return self.cx.evaluate_script(obj, contents, filename, lineno)
+        script = self.script_cache.compile(self.rt, self.cx, obj, contents,
+                                           filename, lineno)
+        return self.cx.execute_script(obj, script)
+
+    @jsexposed(name='require')
+    def _require(self, path):
+        """
+        Implementation for the global require() function, implemented
+        as per the CommonJS SecurableModule specification:
+
+        http://wiki.commonjs.org/wiki/CommonJS/Modules/SecurableModules
+        """
+
+        curr_script = self.get_calling_script()
+        filename = self.__bundle.find_module(curr_script, path)
+        if not filename:
+            filename = self.fs.find_module(curr_script, path)
+        if not filename:
+            raise pydermonkey.error('Module not found: %s' % path)
+        if filename in self.__modules:
+            self.__require_hits += 1
+        else:
+            self.__require_misses += 1
+            start = time.time()
+            contents = self.__bundle.sources.get(filename)
+            if contents is None:
+                try:
+                    contents = self.fs.open(filename).read()
+                except EnvironmentError:
+                    raise pydermonkey.error('Module not found: %s' % path)
+            self.__observe(self.__require_load_times, 'require_load_seconds',
+                           time.time() - start)
             cx = self.cx
             module = cx.new_object(None, self.__root_proto)
             try: 
@@ -587,24 +2778,54 @@ class JsSandbox(object):
             cx.define_property(module, 'exports', exports)
             self._install_globals(self.wrap_jsobject(module))
             self.__modules[filename] = self.wrap_jsobject(exports)
-            contents = self.fs.open(filename).read()
-            cx.evaluate_script(module, contents, filename, 1)
+            self.__module_scopes[filename] = module
+            self._evaluate(module, contents, filename, 1)
         return self.__modules[filename]
 
+    def preload(self, bundle):
+        """
+        Preloads the given ModuleBundle, so that requiring any of its
+        modules uses the bundled source code and module graph instead
+        of the sandbox's file system. Modules are still evaluated when
+        they're first required, so their exports behave as usual, but
+        their scripts are compiled up front if the sandbox has a
+        script cache.
+        """
+
+        merged = ModuleBundle(self.__bundle.sources,
+                              self.__bundle.resolutions)
+        merged.sources.update(bundle.sources)
+        merged.resolutions.update(bundle.resolutions)
+        if self.script_cache is not None:
+            for filename, contents in bundle.sources.iteritems():
+                self.script_cache.compile(self.rt, self.cx,
+                                          self.root.wrapped_jsobject,
+                                          contents, filename, 1)
+        self.__bundle = merged
+
     def run_script(self, contents, filename='<string>', lineno=1,
                    callback=None, stderr=None):
         """
         Runs the given JS script, returning 0 on success, -1 on failure.
+
+        If the script exceeds the sandbox's quota, a QuotaExceededError
+        is raised.
         """
 
         if stderr is None:
             stderr = sys.stderr
 
         retval = -1
-        cx = self.cx
         try:
-            result = cx.evaluate_script(self.root.wrapped_jsobject,
+            start = time.time()
+            self._enter_js()
+            try:
+                result = self._evaluate(self.root.wrapped_jsobject,
                                         contents, filename, lineno)
+            finally:
+                self._leave_js()
+                self.__observe(self.__run_script_times, 'run_script_seconds',
+                               time.time() - start)
             if callback:
                 callback(self.wrap_jsobject(result))
             retval = 0
@@ -620,58 +2841,1551 @@ class JsSandbox(object):
                                       e.exc_info[2], None, stderr)
         return retval
 
-class HttpFileSystem(object):
+class JsSandboxPool(object):
     """
-    File system through which all resources are loaded over HTTP.
+    A pool of pre-initialized JsSandbox instances that share the same
+    file system and globals, so that the cost of building a sandbox is
+    paid ahead of time rather than on every request.
+
+    Since a JsSandbox must only be used by the thread that created it,
+    each thread using the pool has its own idle sandboxes, which are
+    built, handed out, cleaned up and replaced on that thread: 'size'
+    is the number of idle sandboxes the pool tries to keep warm for
+    each thread, while 'max_size' caps the number of sandboxes that
+    are idle or checked out across all threads. When the pool is
+    full, a thread may displace another thread's idle sandbox, which
+    stays alive until its owner calls into the pool again, so
+    'max_size' isn't a hard limit on the number of live sandboxes.
+    The constructor builds the
+    constructing thread's idle sandboxes; other threads can build
+    theirs ahead of time via warm(). 'globals' is passed to each new
+    sandbox's set_globals(), and 'setup' is an optional callable
+    that's given each new sandbox to perform any further per-sandbox
+    initialization. Any remaining keyword arguments are passed to the
+    JsSandbox constructor.
+
+    A sandbox that's been checked back in is never handed out again;
+    checkin() retires it, and a replacement is built by the thread's
+    next call to warm(), or by checkout() when the thread has no idle
+    sandbox left. If 'recycle' is true, though, retired sandboxes are
+    instead reset via JsSandbox.reset() and prepared again with
+    'globals' and 'setup', which is much cheaper than building new
+    ones; sandboxes whose reset is refused are still retired.
     """
 
-    def __init__(self, base_url):
-        self.base_url = base_url
+    def __init__(self, fs, size=4, max_size=None, setup=None,
+                 globals=None, recycle=False, **kwargs):
+        if max_size is None:
+            max_size = size
+        if size < 0 or max_size < 1 or max_size < size:
+            raise ValueError("Invalid pool size")
 
-    def find_module(self, curr_url, path):
-        import urlparse
+        self.fs = fs
+        self.size = size
+        self.max_size = max_size
+        self.setup = setup
+        self.globals = dict(globals or {})
+        self.recycle = recycle
+        self._kwargs = kwargs
+        self._cond = threading.Condition()
+        # Maps thread identifiers to lists of the idle sandboxes
+        # built by those threads, and to lists of those displaced by
+        # other threads, which are waiting to be cleaned up.
+        self._idle = {}
+        self._displaced = {}
+        self._closed = False
 
-        if path.startswith("."):
-            base_url = curr_url
+        # Number of sandboxes that are idle, checked out or being
+        # built.
+        self._count = 0
+        self.warm()
+
+    def _new_sandbox(self):
+        sandbox = JsSandbox(self.fs, **self._kwargs)
+        try:
+            self._prepare(sandbox)
+        except:
+            sandbox.finish()
+            raise
+        return sandbox
+
+    def _prepare(self, sandbox):
+        if self.globals:
+            sandbox.set_globals(**self.globals)
+        if self.setup:
+            self.setup(sandbox)
+        if self.recycle:
+            # The setup may have added to the standard JS objects.
+            sandbox.snapshot_builtins()
+
+    def _recycle(self, sandbox):
+        # Returns whether the given retired sandbox could be reset and
+        # prepared for reuse.
+        try:
+            if sandbox.reset():
+                sandbox.gc()
+                self._prepare(sandbox)
+                return True
+        except Exception:
+            traceback.print_exc()
+        return False
+
+    def _reserve(self):
+        # Returns whether the pool has room for another sandbox, which
+        # the caller must then build, or release via _release(). If
+        # it's full, an idle sandbox of another thread is displaced to
+        # make room. The pool's lock must be held.
+        if self._count >= self.max_size:
+            ident = thread.get_ident()
+            for owner, idle in self._idle.iteritems():
+                if owner != ident and idle:
+                    self._displaced.setdefault(owner, []).append(idle.pop())
+                    self._count -= 1
+                    break
+        if self._count < self.max_size:
+            self._count += 1
+            return True
+        return False
+
+    def _finish_displaced(self):
+        # Cleans up the calling thread's displaced sandboxes.
+        self._cond.acquire()
+        try:
+            displaced = self._displaced.pop(thread.get_ident(), [])
+        finally:
+            self._cond.release()
+        for sandbox in displaced:
+            sandbox.finish()
+
+    def _release(self, sandbox=None):
+        # Gives up a reserved slot, finishing the given sandbox, if
+        # any, first.
+        if sandbox is not None:
+            sandbox.finish()
+        self._cond.acquire()
+        try:
+            self._count -= 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _take_idle(self):
+        # Removes and returns the calling thread's idle sandboxes.
+        self._cond.acquire()
+        try:
+            return self._idle.pop(thread.get_ident(), [])
+        finally:
+            self._cond.release()
+
+    def warm(self):
+        """
+        Builds idle sandboxes for the calling thread until it has
+        'size' of them or the pool is at its maximum size.
+        """
+
+        self._finish_displaced()
+        ident = thread.get_ident()
+        while True:
+            self._cond.acquire()
+            try:
+                if (self._closed or
+                    len(self._idle.get(ident, ())) >= self.size or
+                    self._count >= self.max_size):
+                    return
+                self._count += 1
+            finally:
+                self._cond.release()
+            self._add_idle(self._build())
+
+    def _build(self):
+        # Builds a sandbox in a reserved slot, releasing the slot if
+        # that fails.
+        try:
+            return self._new_sandbox()
+        except:
+            self._release()
+            raise
+
+    def _add_idle(self, sandbox):
+        # Makes the given sandbox, which was built by the calling
+        # thread in a reserved slot, available to it, unless the pool
+        # has been closed or the thread has enough idle sandboxes.
+        self._cond.acquire()
+        try:
+            idle = self._idle.setdefault(thread.get_ident(), [])
+            keep = not self._closed and len(idle) < self.size
+            if keep:
+                idle.append(sandbox)
+        finally:
+            self._cond.release()
+        if not keep:
+            self._release(sandbox)
+
+    def checkout(self, timeout=None):
+        """
+        Returns a ready-to-use sandbox from the calling thread's idle
+        sandboxes, building a new one if it has none and the pool isn't
+        at its maximum size.
+
+        If the pool is at its maximum size, an idle sandbox of another
+        thread is displaced to make room; it's cleaned up by that
+        thread the next time it calls into the pool. If all sandboxes
+        are checked out, this blocks for up to 'timeout' seconds (or
+        forever, if it's None) before raising a RuntimeError.
+        """
+
+        self._finish_displaced()
+        ident = thread.get_ident()
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._cond.acquire()
+        try:
+            while True:
+                if self._closed:
+                    idle = self._idle.pop(ident, [])
+                    break
+                idle = self._idle.get(ident)
+                if idle:
+                    return idle.pop()
+                if self._reserve():
+                    break
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError("No sandbox available")
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+        if self._closed:
+            for sandbox in idle:
+                self._release(sandbox)
+            raise RuntimeError("Sandbox pool is closed")
+        return self._build()
+
+    def checkin(self, sandbox):
+        """
+        Returns a sandbox obtained from checkout() to the pool. This
+        must be called by the thread that checked the sandbox out, and
+        the sandbox must not be used by the caller afterwards.
+
+        The sandbox is retired or recycled before this returns, so
+        that the work is done by the thread the sandbox belongs to.
+        Retired sandboxes aren't replaced here, so that callers such
+        as submit() don't pay for building a new one; call warm() at
+        a convenient time to do so ahead of the next checkout().
+        """
+
+        self._finish_displaced()
+        if self._closed:
+            self._release(sandbox)
+            return
+
+        if self.recycle and self._recycle(sandbox):
+            self._add_idle(sandbox)
         else:
-            base_url = self.base_url
+            self._release(sandbox)
 
-        url = "%s.js" % urlparse.urljoin(base_url, path)
-        if not url.startswith(self.base_url):
-            return None
-        return url
+    def submit(self, contents, filename='<string>', lineno=1,
+               callback=None, stderr=None, timeout=None):
+        """
+        Runs the given JS script in a sandbox from the pool, returning
+        the result of the sandbox's run_script(). The sandbox is
+        checked back in once the script has finished, so 'callback'
+        must be done with the wrapped result by the time it returns.
+        """
 
-    def open(self, url):
-        import urllib
+        sandbox = self.checkout(timeout)
+        try:
+            return sandbox.run_script(contents, filename, lineno,
+                                      callback, stderr)
+        finally:
+            self.checkin(sandbox)
 
-        return urllib.urlopen(url)
+    def close(self):
+        """
+        Closes the pool and cleans up the calling thread's idle
+        sandboxes. Since sandboxes can only be cleaned up by the
+        threads that built them, every other thread that used the pool
+        should call close() as well, or checkout(), which then raises
+        a RuntimeError; the sandboxes of threads that exit without
+        doing so are never cleaned up. Sandboxes that are still
+        checked out are cleaned up when they're checked in.
+        """
 
-class LocalFileSystem(object):
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        self._finish_displaced()
+        for sandbox in self._take_idle():
+            self._release(sandbox)
+
+def _run_sandbox_job(quota, fs_factory, globals_factory, contents,
+                     filename):
     """
-    File system through which all resources are loaded over the local
-    filesystem.
+    Runs the given script in a new sandbox, returning a dictionary of
+    plain data describing the outcome; see ProcessSandboxExecutor.
     """
 
-    def __init__(self, root_dir):
-        self.root_dir = root_dir
+    sandbox = JsSandbox(fs_factory(), quota=quota)
+    try:
+        if globals_factory is not None:
+            sandbox.set_globals(**globals_factory(sandbox))
+        return _run_script_job(sandbox, contents, filename)
+    finally:
+        sandbox.finish()
 
-    def find_module(self, curr_script, path):
-        import os
+def _run_script_job(sandbox, contents, filename):
+    # Runs the given script in the given sandbox, returning a dictionary
+    # of plain data describing the outcome.
+    import StringIO
 
-        if path.startswith("."):
-            base_dir = os.path.dirname(curr_script)
-        else:
-            base_dir = self.root_dir
+    results = []
+    result = None
+    stderr = StringIO.StringIO()
+    try:
+        retval = sandbox.run_script(contents, filename,
+                                    callback=results.append,
+                                    stderr=stderr)
+        usage = sandbox.last_usage
+        if results:
+            # The conversion may run JS getters, so it's done within
+            # the quota too.
+            result = sandbox.to_python(results.pop())
+    except QuotaExceededError, e:
+        retval = -1
+        usage = sandbox.last_usage
+        stderr.write("%s\n%s\n" % (format_stack(e.js_stack,
+                                                 sandbox.fs.open),
+                                    e))
+    return dict(retval = retval,
+                result = result,
+                stderr = stderr.getvalue(),
+                usage = usage)
 
-        ospath = path.replace('/', os.path.sep)
-        filename = os.path.join(base_dir, "%s.js" % ospath)
-        filename = os.path.normpath(filename)
-        if (filename.startswith(self.root_dir) and
-            (os.path.exists(filename) and
-             not os.path.isdir(filename))):
-            return filename
-        else:
-            return None
+def _get_fork_shared(*objects):
+    # Returns the global watchdog, caches and HTTP transport, along
+    # with any of the given objects that are distinct from them: the
+    # objects whose locks other threads may hold while a child process
+    # is forked, and whose state the child shares with its parent.
+    shared = []
+    for obj in (watchdog, script_cache, source_cache, http_transport,
+                line_cache) + objects:
+        if obj is not None and not [other for other in shared
+                                    if other is obj]:
+            shared.append(obj)
+    return shared
 
-    def open(self, filename):
-        return open(filename, 'r')
+@contextlib.contextmanager
+def _holding_locks(objects):
+    # Holds the locks of the given objects, e.g. across a fork, so
+    # that a child process doesn't inherit any of them in the state a
+    # thread that doesn't exist in the child left them in.
+    locks = [obj._lock for obj in objects]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+def _reinit_after_fork(objects):
+    # Called in a child process forked while _holding_locks() held
+    # the given objects' locks. Watchdogs are left alone, since their
+    # threads don't survive the fork and they need to be replaced.
+    for obj in objects:
+        if isinstance(obj, ContextWatchdogThread):
+            continue
+        obj._lock = threading.Lock()
+        if isinstance(obj, HttpTransport):
+            # The idle connections' sockets are shared with the
+            # parent, so requests made on them would get mixed up
+            # with its own; they're closed along with the parent's
+            # copies.
+            obj._idle = {}
+
+def _sandbox_worker_main(conn, parent_conn, quota):
+    # Entry point for ProcessSandboxExecutor worker processes.
+    parent_conn.close()
+    _reinit_after_fork(_get_fork_shared())
+    restart_watchdog()
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+        try:
+            response = (True, _run_sandbox_job(quota, *job))
+        except Exception:
+            response = (False, traceback.format_exc())
+        conn.send(response)
+
+class ProcessSandboxExecutor(object):
+    """
+    Runs JS scripts in sandboxes hosted by a pool of worker processes,
+    so that JS code can make use of multiple CPU cores. Each worker has
+    its own JS runtimes and watchdog.
+
+    'processes' is the number of workers, defaulting to the number of
+    CPUs. 'quota' is an optional Quota applied to each script. A job
+    that takes longer than 'timeout' seconds has its worker killed,
+    and workers are restarted whenever they crash or are killed, or
+    after running 'max_jobs_per_worker' jobs.
+    """
+
+    def __init__(self, processes=None, quota=None, timeout=None,
+                 max_jobs_per_worker=None):
+        import multiprocessing
+        import Queue
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.quota = quota
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.restarts = 0
+        self._jobs = Queue.Queue()
+        self._start_lock = threading.Lock()
+        self._shutdown = False
+        self._threads = []
+        for i in range(processes):
+            thread = threading.Thread(target=self._manage_worker)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _start_worker(self):
+        import multiprocessing
+
+        # Workers are started one at a time, so that no worker inherits
+        # another's end of its connection; otherwise, we wouldn't
+        # notice when the other worker dies.
+        self._start_lock.acquire()
+        try:
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_sandbox_worker_main,
+                                              args=(child_conn, conn,
+                                                    self.quota))
+            process.daemon = True
+            with _holding_locks(_get_fork_shared()):
+                process.start()
+            child_conn.close()
+        finally:
+            self._start_lock.release()
+        return process, conn
+
+    def _stop_worker(self, process, conn, wait=0):
+        if wait:
+            try:
+                conn.send(None)
+            except EnvironmentError:
+                pass
+        conn.close()
+        process.join(wait)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+    def _manage_worker(self):
+        process, conn = self._start_worker()
+        jobs_run = 0
+        try:
+            while True:
+                item = self._jobs.get()
+                if item is None:
+                    break
+                future, job = item
+                restart = False
+                try:
+                    conn.send(job)
+                    if not conn.poll(self.timeout):
+                        raise RuntimeError("Job exceeded timeout of %s "
+                                           "seconds" % self.timeout)
+                    success, response = conn.recv()
+                except EOFError:
+                    restart = True
+                    error = RuntimeError("Worker process died")
+                    future.set_exception((RuntimeError, error, None))
+                except Exception:
+                    restart = True
+                    future.set_exception(sys.exc_info())
+                else:
+                    if success:
+                        future.set_result(response)
+                    else:
+                        error = RuntimeError(response)
+                        future.set_exception((RuntimeError, error, None))
+
+                jobs_run += 1
+                if (self.max_jobs_per_worker and
+                    jobs_run >= self.max_jobs_per_worker):
+                    restart = True
+                if restart:
+                    self._stop_worker(process, conn, wait=0.5)
+                    self.restarts += 1
+                    process, conn = self._start_worker()
+                    jobs_run = 0
+        finally:
+            self._stop_worker(process, conn, wait=5)
+
+    def submit(self, fs_factory, contents, globals_factory=None,
+               filename='<string>'):
+        """
+        Queues the given JS script to be run in a new sandbox in one of
+        the worker processes, returning a Future for its result.
+
+        'fs_factory' is a picklable callable that returns the file
+        system for the sandbox, e.g. functools.partial(LocalFileSystem,
+        root_dir). 'globals_factory' is an optional picklable callable
+        that's passed the new sandbox and returns a dictionary of its
+        globals.
+
+        The result is a dictionary containing the script's return value
+        from JsSandbox.run_script() as 'retval', the script's result
+        converted to plain data via JsSandbox.to_python() as 'result',
+        anything the script wrote to stderr as 'stderr', and the
+        resources it used as 'usage'.
+        """
+
+        if self._shutdown:
+            raise RuntimeError("Executor has been shut down")
+        future = Future()
+        self._jobs.put((future, (fs_factory, globals_factory, contents,
+                                 filename)))
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the worker processes once all queued jobs have finished.
+        """
+
+        self._shutdown = True
+        for thread in self._threads:
+            self._jobs.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+class SandboxForkServer(object):
+    """
+    Keeps a fully initialized template JsSandbox, with its globals set
+    and a list of common modules already required, and runs jobs in
+    child processes forked from it. Each child inherits the template's
+    state copy-on-write, so it's ready to run JS code immediately, and
+    nothing a job does affects the template or any other job.
+
+    'modules' is a list of module paths to require in the template,
+    'globals' is an optional dictionary of its globals, and 'setup' is
+    an optional callable that's passed the template for any further
+    initialization. Remaining keyword arguments are passed on to
+    JsSandbox.
+
+    Because it forks, this is only available on POSIX systems. Like
+    any JsSandbox, the template must only be used by the thread that
+    created it, so fork(), submit() and close() must be called by the
+    thread that created the server; each child runs its job on the
+    forking thread's copy. Other threads that need to run jobs should
+    have their own server.
+    """
+
+    def __init__(self, fs, modules=(), globals=None, setup=None,
+                 **kwargs):
+        self.sandbox = JsSandbox(fs, **kwargs)
+        self._owner = thread.get_ident()
+        self._lock = threading.Lock()
+        # The read ends of the pipes of jobs whose results haven't
+        # been collected yet, which are closed by the threads that
+        # collect them.
+        self._read_fds = set()
+        try:
+            if globals:
+                self.sandbox.set_globals(**globals)
+            for path in modules:
+                self._require(path)
+            if setup is not None:
+                setup(self.sandbox)
+        except:
+            self.sandbox.finish()
+            raise
+
+    def _require(self, path):
+        import json
+        import StringIO
+
+        stderr = StringIO.StringIO()
+        if self.sandbox.run_script("require(%s);" % json.dumps(path),
+                                   stderr=stderr) != 0:
+            raise RuntimeError("Requiring %s failed:\n%s" %
+                               (path, stderr.getvalue()))
+
+    def _check_owner(self):
+        if thread.get_ident() != self._owner:
+            raise RuntimeError("SandboxForkServer used by a thread other "
+                               "than the one that created it")
+
+    def _get_shared(self):
+        sandbox = self.sandbox
+        return _get_fork_shared(sandbox.watchdog, sandbox.script_cache,
+                                getattr(sandbox.fs, 'source_cache', None),
+                                getattr(sandbox.fs, 'transport', None))
+
+    def _fork(self, shared):
+        # Locks that other threads may hold are acquired across the
+        # fork, so that they're in a consistent, released state in the
+        # child.
+        with _holding_locks(shared):
+            return os.fork()
+
+    def _restart_watchdog(self):
+        # The watchdog's thread doesn't survive the fork, so the child
+        # needs a new one watching the template's context.
+        old_watchdog = self.sandbox.watchdog
+        if old_watchdog is _get_global_watchdog():
+            new_watchdog = restart_watchdog()
+        else:
+            new_watchdog = ContextWatchdogThread(old_watchdog.interval)
+            new_watchdog._adopt_contexts(old_watchdog)
+            new_watchdog.start()
+        self.sandbox.watchdog = new_watchdog
+
+    def _run_child(self, write_fd, shared, func, args):
+        import cPickle
+
+        status = 1
+        try:
+            _reinit_after_fork(shared)
+            self._restart_watchdog()
+            try:
+                response = (True, func(self.sandbox, *args))
+            except Exception:
+                response = (False, traceback.format_exc())
+            data = cPickle.dumps(response, cPickle.HIGHEST_PROTOCOL)
+            while data:
+                data = data[os.write(write_fd, data):]
+            status = 0
+        finally:
+            os._exit(status)
+
+    def _collect(self, pid, read_fd, future, timeout):
+        import cPickle
+        import select
+        import signal
+
+        chunks = []
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if (remaining <= 0 or
+                        not select.select([read_fd], [], [], remaining)[0]):
+                        os.kill(pid, signal.SIGKILL)
+                        raise RuntimeError("Job exceeded timeout of %s "
+                                           "seconds" % timeout)
+                chunk = os.read(read_fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            if not chunks:
+                raise RuntimeError("Worker process died")
+            success, response = cPickle.loads(''.join(chunks))
+        except Exception:
+            future.set_exception(sys.exc_info())
+        else:
+            if success:
+                future.set_result(response)
+            else:
+                error = RuntimeError(response)
+                future.set_exception((RuntimeError, error, None))
+        finally:
+            self._lock.acquire()
+            try:
+                self._read_fds.discard(read_fd)
+                os.close(read_fd)
+            finally:
+                self._lock.release()
+            os.waitpid(pid, 0)
+
+    def fork(self, func, *args, **kwargs):
+        """
+        Calls the given callable with a copy of the template sandbox,
+        followed by the given arguments, in a newly forked child
+        process, returning a Future for its result, which must be
+        picklable.
+
+        If the 'timeout' keyword argument is given, the child is
+        killed if it takes longer than that many seconds.
+        """
+
+        timeout = kwargs.pop('timeout', None)
+        if kwargs:
+            raise TypeError("Unexpected keyword arguments: %s" %
+                            ", ".join(kwargs))
+
+        self._check_owner()
+        future = Future()
+        shared = self._get_shared()
+        # The read ends of earlier jobs' pipes are closed in the child,
+        # and this pipe's write end is closed here right after forking,
+        # so that no other job's child keeps it open, which would keep
+        # us from noticing when this job's child exits.
+        self._lock.acquire()
+        try:
+            read_fd, write_fd = os.pipe()
+            try:
+                pid = self._fork(shared)
+            except:
+                os.close(read_fd)
+                os.close(write_fd)
+                raise
+            if pid == 0:
+                for fd in self._read_fds:
+                    os.close(fd)
+                os.close(read_fd)
+                self._run_child(write_fd, shared, func, args)
+            os.close(write_fd)
+            self._read_fds.add(read_fd)
+        finally:
+            self._lock.release()
+        collector = threading.Thread(target=self._collect,
+                                     args=(pid, read_fd, future, timeout))
+        collector.setDaemon(True)
+        collector.start()
+        return future
+
+    def submit(self, contents, filename='<string>', timeout=None):
+        """
+        Runs the given JS script in a child process forked from the
+        template sandbox, returning a Future for its result, which is
+        the same as for ProcessSandboxExecutor.submit().
+        """
+
+        return self.fork(_run_script_job, contents, filename,
+                         timeout=timeout)
+
+    def close(self):
+        """
+        Cleans up the template sandbox.
+        """
+
+        self._check_owner()
+        self.sandbox.finish()
+
+# Matches require() calls with a literal module path.
+_REQUIRE_RE = re.compile(r"""\brequire\s*\(\s*(['"])([^'"\\]+)\1\s*\)""")
+
+def scan_requires(contents):
+    """
+    Returns a list of the module paths passed as string literals to
+    require() calls in the given JS source code, in order of first
+    appearance.
+    """
+
+    paths = []
+    for match in _REQUIRE_RE.finditer(contents):
+        path = match.group(2)
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+def _load_module_graph(fs, paths, max_workers, curr_script='<string>'):
+    """
+    Statically discovers the modules reachable via require() calls
+    from the given module paths, as required by 'curr_script', loading
+    each level of the module graph concurrently.
+
+    Returns a tuple consisting of an ordered dictionary mapping module
+    filenames to their source code, and a dictionary mapping
+    (requiring filename, path) tuples to the resolved filenames.
+    Modules that can't be found or loaded are left out.
+    """
+
+    sources = collections.OrderedDict()
+    resolutions = {}
+    pending = [(curr_script, path) for path in paths]
+    while pending:
+        to_load = []
+        for key in pending:
+            filename = fs.find_module(*key)
+            if not filename:
+                continue
+            resolutions[key] = filename
+            if filename not in sources and filename not in to_load:
+                to_load.append(filename)
+
+        results = _map_threaded(lambda filename: fs.open(filename).read(),
+                                to_load, max_workers)
+        pending = []
+        for filename, (contents, exc_info) in zip(to_load, results):
+            if exc_info is None:
+                sources[filename] = contents
+                pending.extend((filename, path)
+                               for path in scan_requires(contents))
+    return sources, resolutions
+
+class ModuleBundle(object):
+    """
+    The source code of a set of modules and the module graph
+    connecting them, as found by statically scanning their require()
+    calls, which can be preloaded into a JsSandbox so that requiring
+    the modules involves no file system access.
+
+    A bundle can be saved to, and loaded from, a JSON file.
+    """
+
+    # Default maximum number of concurrent loads made by build().
+    DEFAULT_MAX_WORKERS = 8
+
+    def __init__(self, sources=None, resolutions=None):
+        self.sources = collections.OrderedDict(sources or {})
+        self.resolutions = dict(resolutions or {})
+
+    @classmethod
+    def build(cls, fs, paths, max_workers=DEFAULT_MAX_WORKERS,
+              curr_script='<string>'):
+        """
+        Builds a bundle of the given modules, as required by
+        'curr_script', along with every module they statically
+        require. Modules are resolved via fs.find_module(), and each
+        level of the module graph is fetched concurrently, using up to
+        'max_workers' threads.
+
+        Modules that can't be found, or are only required with
+        non-literal paths, are left out of the bundle; requiring them
+        from a sandbox falls back to its file system.
+        """
+
+        sources, resolutions = _load_module_graph(fs, paths, max_workers,
+                                                  curr_script)
+        return cls(sources, resolutions)
+
+    def find_module(self, curr_script, path):
+        """
+        Returns the filename the given path was resolved to when
+        required by 'curr_script', or None if it isn't in the bundle.
+        """
+
+        return self.resolutions.get((curr_script, path))
+
+    def save(self, stream):
+        import json
+
+        json.dump({'sources': self.sources.items(),
+                   'resolutions': [[curr_script, path, filename]
+                                   for ((curr_script, path), filename)
+                                   in self.resolutions.items()]},
+                  stream)
+
+    @classmethod
+    def load(cls, stream):
+        import json
+
+        data = json.load(stream)
+        resolutions = dict(((curr_script, path), filename)
+                           for curr_script, path, filename
+                           in data['resolutions'])
+        return cls(data['sources'], resolutions)
+
+    def __len__(self):
+        return len(self.sources)
+
+    def __contains__(self, filename):
+        return filename in self.sources
+
+class AsyncJsSandbox(object):
+    """
+    A non-blocking front end for a JsSandbox, which is created and used
+    exclusively by a dedicated thread. Rather than blocking, methods
+    return Future objects that can be waited on, or given callbacks to
+    be notified of their result, e.g. to integrate with an event loop.
+
+    Arguments are the same as for JsSandbox.
+    """
+
+    # Default maximum number of concurrent loads made by prefetch().
+    DEFAULT_PREFETCH_WORKERS = 8
+
+    def __init__(self, fs, **kwargs):
+        import Queue
+
+        self.fs = fs
+        self._jobs = Queue.Queue()
+        self._lock = threading.RLock()
+        self._finished = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._sandbox = None
+        # Calls that use the sandbox re-raise any error raised while
+        # creating it.
+        self._created = self.submit(self._create_sandbox, fs, kwargs)
+
+    def _create_sandbox(self, fs, kwargs):
+        self._sandbox = JsSandbox(fs, **kwargs)
+
+    def _run(self):
+        while True:
+            item = self._jobs.get()
+            if item is None:
+                break
+            future, func, args, kwargs = item
+            try:
+                result = func(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+            del item, future, func, args, kwargs
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Calls the given callable with the given arguments on the
+        sandbox's thread, returning a Future for its result. A
+        RuntimeError is raised if the sandbox has been finished.
+        """
+
+        future = Future()
+        self._lock.acquire()
+        try:
+            if self._finished:
+                raise RuntimeError("AsyncJsSandbox has been finished")
+            self._jobs.put((future, func, args, kwargs))
+        finally:
+            self._lock.release()
+        return future
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls the given callable with the sandbox and the given
+        arguments on the sandbox's thread, returning a Future for its
+        result. This is how the sandbox should be accessed, since it
+        must only be used by its own thread. If creating the sandbox
+        failed, the Future raises the same error.
+        """
+
+        def call_with_sandbox():
+            self._created.result()
+            return func(self._sandbox, *args, **kwargs)
+        return self.submit(call_with_sandbox)
+
+    def run_script(self, contents, filename='<string>', lineno=1,
+                   callback=None, stderr=None):
+        """
+        Runs the given JS script as per JsSandbox.run_script(),
+        returning a Future for its return value. The callback, if any,
+        is called on the sandbox's thread.
+        """
+
+        return self.call(JsSandbox.run_script, contents, filename, lineno,
+                         callback, stderr)
+
+    def async_function(self, function):
+        """
+        Returns a callable that calls the given SafeJsFunctionWrapper
+        on the sandbox's thread, returning a Future for its result.
+        """
+
+        def call_function(*args):
+            return self.submit(function, *args)
+        return call_function
+
+    def prefetch(self, paths, max_workers=DEFAULT_PREFETCH_WORKERS):
+        """
+        Loads the given modules, along with all the modules they
+        statically require, on a separate thread, and then preloads
+        them into the sandbox as a ModuleBundle. Returns a Future for
+        a list of the filenames of the loaded modules.
+        """
+
+        future = Future()
+
+        def preload(sandbox, bundle):
+            sandbox.preload(bundle)
+            return bundle.sources.keys()
+
+        def on_preloaded(preloaded):
+            try:
+                future.set_result(preloaded.result())
+            except:
+                future.set_exception(sys.exc_info())
+
+        def load():
+            try:
+                bundle = ModuleBundle.build(self.fs, paths, max_workers)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                try:
+                    preloaded = self.call(preload, bundle)
+                except:
+                    future.set_exception(sys.exc_info())
+                else:
+                    preloaded.add_done_callback(on_preloaded)
+
+        thread = threading.Thread(target=load)
+        thread.setDaemon(True)
+        thread.start()
+        return future
+
+    def finish(self):
+        """
+        Cleans up the sandbox once all pending calls have finished and
+        stops its thread, returning a Future that's done when the
+        sandbox has been cleaned up. No further calls can be made
+        afterwards.
+        """
+
+        self._lock.acquire()
+        try:
+            future = self.call(JsSandbox.finish)
+            self._finished = True
+            self._jobs.put(None)
+        finally:
+            self._lock.release()
+        return future
+
+class SourceCache(object):
+    """
+    A bounded, least-recently-used cache of module source code that can
+    be shared by any number of file systems, limited by the total size
+    of the sources it holds.
+
+    Each entry is stored along with a validator that the file system
+    that stored it uses to check whether the entry is still fresh.
+    """
+
+    # Default maximum total size, in bytes, of the cached sources.
+    DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns a (validator, contents) tuple for the given key, or
+        None if it isn't in the cache.
+        """
+
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self, key, validator, contents):
+        """
+        Stores the given contents under the given key, evicting the
+        least recently used entries if the cache grows too large.
+        """
+
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            if len(contents) > self.max_bytes:
+                return
+            self._entries[key] = (validator, contents)
+            self.size += len(contents)
+            while self.size > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                self.size -= len(old[1])
+        finally:
+            self._lock.release()
+
+    def record_hit(self):
+        self._lock.acquire()
+        try:
+            self.hits += 1
+        finally:
+            self._lock.release()
+
+    def record_miss(self):
+        self._lock.acquire()
+        try:
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """
+        Returns a dictionary of statistics about the cache.
+        """
+
+        self._lock.acquire()
+        try:
+            return dict(hits = self.hits,
+                        misses = self.misses,
+                        entries = len(self._entries),
+                        size = self.size,
+                        max_bytes = self.max_bytes)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+# Create a global source cache.
+source_cache = SourceCache()
+
+def _map_threaded(func, items, max_workers):
+    """
+    Calls 'func' on each of the given items using up to 'max_workers'
+    threads, returning a list of (result, exc_info) tuples in the same
+    order as the items, where exactly one element of each tuple is
+    None.
+    """
+
+    items = list(items)
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            lock.acquire()
+            try:
+                if not pending:
+                    return
+                index, item = pending.pop(0)
+            finally:
+                lock.release()
+            try:
+                results[index] = (func(item), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_workers, len(items)))]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+class Future(object):
+    """
+    The eventual result of a job that's run on another thread or in
+    another process.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.isSet()
+
+    def _finish(self, result, exc_info):
+        self._lock.acquire()
+        try:
+            if self._done.isSet():
+                return
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exc_info):
+        """
+        Sets the exception raised by the job, given as a tuple in the
+        form returned by sys.exc_info().
+        """
+
+        self._finish(None, exc_info)
+
+    def add_done_callback(self, callback):
+        """
+        Arranges for the given callable to be called with this future
+        when the job is done, or immediately if it already is.
+        """
+
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def result(self, timeout=None):
+        """
+        Waits up to 'timeout' seconds (or forever, if it's None) for
+        the job to finish and returns its result, re-raising any
+        exception it raised.
+        """
+
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            raise RuntimeError("Timed out waiting for result")
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+class HttpTransport(object):
+    """
+    Fetches resources over HTTP, keeping the connections to each host
+    alive so that they can be reused by later requests.
+
+    'timeout' is the timeout, in seconds, for connecting to a host and
+    for each read from it, while 'max_idle' is the maximum number of
+    idle connections kept open to each host.
+    """
+
+    # Default timeout, in seconds, for network operations.
+    DEFAULT_TIMEOUT = 10
+
+    # Default maximum number of idle connections kept open per host.
+    DEFAULT_MAX_IDLE = 4
+
+    # Maximum number of redirects followed for a single request.
+    MAX_REDIRECTS = 5
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_idle=DEFAULT_MAX_IDLE):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.connections_opened = 0
+        self.requests = 0
+
+    def _get_connection(self, key):
+        import httplib
+
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+            self.connections_opened += 1
+        finally:
+            self._lock.release()
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        return conn_class(host, port, timeout=self.timeout), False
+
+    def _release_connection(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                conn = None
+        finally:
+            self._lock.release()
+        if conn is not None:
+            conn.close()
+
+    def _request(self, url, headers):
+        import httplib
+        import socket
+        import urlparse
+
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise IOError("Unsupported URL scheme: %s" % url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+
+        while True:
+            conn, reused = self._get_connection(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                if reused:
+                    # The server probably closed the idle connection;
+                    # try again with a different one.
+                    continue
+                if isinstance(e, IOError):
+                    raise
+                raise IOError("Error fetching %s: %r" % (url, e))
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(key, conn)
+            return response.status, response.msg, body
+
+    def fetch(self, url, headers=None):
+        """
+        Performs a GET request for the given URL with the given
+        headers, following any redirects, and returns a tuple
+        consisting of the response's status code, its headers as a
+        mimetools.Message, and its body.
+        """
+
+        import urlparse
+
+        if headers is None:
+            headers = {}
+        for i in range(self.MAX_REDIRECTS + 1):
+            status, msg, body = self._request(url, headers)
+            location = msg.getheader('Location')
+            if status in (301, 302, 303, 307) and location:
+                url = urlparse.urljoin(url, location)
+            else:
+                return status, msg, body
+        raise IOError("Too many redirects: %s" % url)
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+# Create a global HTTP transport.
+http_transport = HttpTransport()
+
+class HttpFileSystem(object):
+    """
+    File system through which all resources are loaded over HTTP.
+
+    If 'source_cache' isn't None, loaded resources are kept in it and
+    revalidated with conditional requests based on their ETag and
+    Last-Modified headers. Requests are made through the given
+    HttpTransport, which by default is shared by all HTTP file
+    systems.
+    """
+
+    # Default maximum number of concurrent requests made by prefetch().
+    DEFAULT_PREFETCH_WORKERS = 8
+
+    def __init__(self, base_url, source_cache=source_cache,
+                 transport=http_transport):
+        self.base_url = base_url
+        self.source_cache = source_cache
+        self.transport = transport
+
+    def find_module(self, curr_url, path):
+        import urlparse
+
+        if path.startswith("."):
+            base_url = curr_url
+        else:
+            base_url = self.base_url
+
+        url = "%s.js" % urlparse.urljoin(base_url, path)
+        if not url.startswith(self.base_url):
+            return None
+        return url
+
+    def read(self, url):
+        cache = self.source_cache
+        entry = None
+        headers = {}
+        if cache is not None:
+            entry = cache.get(url)
+            if entry is not None:
+                etag, last_modified = entry[0]
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+        status, msg, contents = self.transport.fetch(url, headers)
+        if status == 304 and entry is not None:
+            cache.record_hit()
+            return entry[1]
+        if status != 200:
+            raise IOError("HTTP error %d: %s" % (status, url))
+
+        if cache is not None:
+            cache.record_miss()
+            validator = (msg.getheader('ETag'),
+                         msg.getheader('Last-Modified'))
+            if validator != (None, None):
+                cache.put(url, validator, contents)
+        line_cache.invalidate(url)
+        return contents
+
+    def open(self, url):
+        import StringIO
+
+        return StringIO.StringIO(self.read(url))
+
+    def prefetch(self, urls, max_workers=DEFAULT_PREFETCH_WORKERS):
+        """
+        Concurrently loads the given URLs, such as those of modules
+        that are about to be required, so that they're already in the
+        source cache when they're needed. Returns a dictionary mapping
+        each URL to its contents, or to None if it couldn't be loaded.
+        """
+
+        urls = list(urls)
+        results = _map_threaded(self.read, urls, max_workers)
+        return dict((url, contents)
+                    for url, (contents, exc_info) in zip(urls, results))
+
+class LocalFileSystem(object):
+    """
+    File system through which all resources are loaded over the local
+    filesystem.
+
+    If 'source_cache' isn't None, loaded files are kept in it and
+    revalidated against their modification time and size.
+
+    If 'index' is true, the root directory is scanned once up front and
+    modules are resolved against the resulting in-memory index rather
+    than by querying the filesystem. The index can be rebuilt via
+    refresh(); if 'refresh_interval' is given, the modification times
+    of the indexed directories are also checked at most once every
+    'refresh_interval' seconds, and the index is rebuilt if any of
+    them have changed.
+    """
+
+    def __init__(self, root_dir, source_cache=source_cache, index=False,
+                 refresh_interval=None):
+        self.root_dir = root_dir
+        self.source_cache = source_cache
+        self.refresh_interval = refresh_interval
+        self._index = None
+        if index:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Rescans the root directory and rebuilds the module resolution
+        index.
+        """
+
+        import os
+
+        modules = set()
+        dir_mtimes = {}
+        for dirpath, dirnames, filenames in os.walk(self.root_dir,
+                                                    followlinks=True):
+            dir_mtimes[dirpath] = os.stat(dirpath).st_mtime
+            for name in filenames:
+                if name.endswith('.js'):
+                    filename = os.path.join(dirpath, name)
+                    modules.add(os.path.normpath(filename))
+        self._index = (modules, dir_mtimes, time.time())
+
+    def _get_index(self):
+        import os
+
+        modules, dir_mtimes, last_checked = self._index
+        if (self.refresh_interval is not None and
+            time.time() - last_checked > self.refresh_interval):
+            for dirpath, mtime in dir_mtimes.iteritems():
+                try:
+                    if os.stat(dirpath).st_mtime != mtime:
+                        break
+                except OSError:
+                    break
+            else:
+                self._index = (modules, dir_mtimes, time.time())
+                return modules
+            self.refresh()
+            modules = self._index[0]
+        return modules
+
+    def find_module(self, curr_script, path):
+        import os
+
+        if path.startswith("."):
+            base_dir = os.path.dirname(curr_script)
+        else:
+            base_dir = self.root_dir
+
+        ospath = path.replace('/', os.path.sep)
+        filename = os.path.join(base_dir, "%s.js" % ospath)
+        filename = os.path.normpath(filename)
+        if not filename.startswith(self.root_dir):
+            return None
+        if self._index is not None:
+            found = filename in self._get_index()
+        else:
+            found = (os.path.exists(filename) and
+                     not os.path.isdir(filename))
+        if found:
+            return filename
+        else:
+            return None
+
+    def read(self, filename):
+        import os
+
+        cache = self.source_cache
+        if cache is not None:
+            info = os.stat(filename)
+            validator = (info.st_mtime, info.st_size)
+            entry = cache.get(filename)
+            if entry is not None and entry[0] == validator:
+                cache.record_hit()
+                return entry[1]
+
+        f = open(filename, 'r')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+
+        if cache is not None:
+            cache.record_miss()
+            cache.put(filename, validator, contents)
+        line_cache.invalidate(filename)
+        return contents
+
+    def open(self, filename):
+        import StringIO
+
+        return StringIO.StringIO(self.read(filename))
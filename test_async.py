@@ -0,0 +1,91 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for AsyncJsSandbox's handling of its sandbox's lifetime.
+"""
+
+import sys
+import traceback
+
+from pydertron import AsyncJsSandbox, LocalFileSystem
+
+def make_failed_sandbox():
+    # The sandbox can't be created with an unknown throw_capture mode.
+    return AsyncJsSandbox(LocalFileSystem('.'), throw_capture='bogus')
+
+def assert_raises(exc_type, func, *args):
+    try:
+        func(*args)
+    except exc_type:
+        pass
+    else:
+        raise AssertionError("Expected %s" % exc_type.__name__)
+
+def test_creation_errors_are_raised_by_later_calls():
+    async_sandbox = make_failed_sandbox()
+    future = async_sandbox.run_script("1")
+    assert_raises(ValueError, future.result, 10)
+    future = async_sandbox.call(lambda sandbox: sandbox)
+    assert_raises(ValueError, future.result, 10)
+    assert_raises(ValueError, async_sandbox.finish().result, 10)
+
+def test_calls_are_refused_after_finish():
+    async_sandbox = make_failed_sandbox()
+    async_sandbox.finish()
+    assert_raises(RuntimeError, async_sandbox.submit, len, [])
+    assert_raises(RuntimeError, async_sandbox.run_script, "1")
+    assert_raises(RuntimeError, async_sandbox.finish)
+    async_sandbox._thread.join(10)
+    assert not async_sandbox._thread.isAlive()
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
@@ -0,0 +1,89 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for the process-wide registry of the JS-exposed members of
+    JsExposedObject subclasses.
+"""
+
+import gc
+import sys
+import traceback
+import weakref
+
+import pydertron
+from pydertron import JsExposedObject, jsexposed
+
+def make_class():
+    class Counter(JsExposedObject):
+        @jsexposed
+        def add(self, amount, step=1):
+            return amount + step
+    return Counter
+
+def test_methods_are_found_with_their_arity():
+    Counter = make_class()
+    info = pydertron._get_exposed_class_info(Counter)
+    assert pydertron._get_exposed_class_info(Counter) is info
+    assert [(name, arity) for name, func, arity in info.methods] == \
+           [('add', (1, 2))]
+
+def test_entries_go_away_with_their_classes():
+    Counter = make_class()
+    pydertron._get_exposed_class_info(Counter)
+    assert Counter in pydertron._exposed_classes
+    ref = weakref.ref(Counter)
+    del Counter
+    gc.collect()
+    assert ref() is None
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
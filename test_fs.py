@@ -0,0 +1,135 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+"""
+    Tests for Pydertron's local file system, run against a temporary
+    directory.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from pydertron import LocalFileSystem, SourceCache
+
+def make_tree(files):
+    root_dir = tempfile.mkdtemp()
+    for name, contents in files.items():
+        write(root_dir, name, contents)
+    return root_dir
+
+def write(root_dir, name, contents):
+    filename = os.path.join(root_dir, name)
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    f = open(filename, 'w')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    return filename
+
+def test_modules_are_resolved():
+    root_dir = make_tree({'a.js': '', 'lib/b.js': ''})
+    for index in [False, True]:
+        fs = LocalFileSystem(root_dir, index=index)
+        a = fs.find_module('<string>', 'a')
+        assert a == os.path.join(root_dir, 'a.js')
+        assert fs.find_module(a, './lib/b') == os.path.join(root_dir,
+                                                            'lib', 'b.js')
+        assert fs.find_module('<string>', 'missing') is None
+        assert fs.find_module('<string>', 'lib') is None
+        assert fs.find_module(a, '../outside') is None
+    shutil.rmtree(root_dir)
+
+def test_index_is_only_rebuilt_on_refresh():
+    root_dir = make_tree({'a.js': ''})
+    fs = LocalFileSystem(root_dir, index=True)
+    write(root_dir, 'b.js', '')
+    assert fs.find_module('<string>', 'b') is None
+    fs.refresh()
+    assert fs.find_module('<string>', 'b') == os.path.join(root_dir, 'b.js')
+    os.remove(os.path.join(root_dir, 'a.js'))
+    fs.refresh()
+    assert fs.find_module('<string>', 'a') is None
+    shutil.rmtree(root_dir)
+
+def test_index_is_rebuilt_when_directories_change():
+    root_dir = make_tree({'a.js': '', 'lib/b.js': ''})
+    fs = LocalFileSystem(root_dir, index=True, refresh_interval=0.05)
+    write(root_dir, 'lib/c.js', '')
+    # Make sure the directory's modification time changes, even on
+    # file systems with coarse timestamps.
+    lib_dir = os.path.join(root_dir, 'lib')
+    mtime = os.stat(lib_dir).st_mtime + 10
+    os.utime(lib_dir, (mtime, mtime))
+    assert fs.find_module('<string>', 'lib/c') is None
+    time.sleep(0.1)
+    assert fs.find_module('<string>', 'lib/c') == os.path.join(lib_dir,
+                                                               'c.js')
+    shutil.rmtree(root_dir)
+
+def test_sources_are_cached_until_modified():
+    root_dir = make_tree({'a.js': 'exports.a = 1;'})
+    fs = LocalFileSystem(root_dir, source_cache=SourceCache())
+    filename = fs.find_module('<string>', 'a')
+    assert fs.read(filename) == 'exports.a = 1;'
+    assert fs.read(filename) == 'exports.a = 1;'
+    assert fs.source_cache.hits == 1
+    write(root_dir, 'a.js', 'exports.a = 22;')
+    assert fs.read(filename) == 'exports.a = 22;'
+    assert fs.source_cache.misses == 2
+    shutil.rmtree(root_dir)
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
@@ -0,0 +1,183 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""
+    Tests for Pydertron's HTTP file system, run against a local
+    stand-in HTTP server.
+"""
+
+import sys
+import threading
+import traceback
+import BaseHTTPServer
+import SocketServer
+
+from pydertron import HttpFileSystem, HttpTransport, SourceCache
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP/1.1 server that serves the files in its 'files'
+    dictionary, supporting keep-alive connections and ETag-based
+    conditional requests.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StandInHandler)
+        self.files = {}
+        self.connections = 0
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        path = self.path.lstrip('/')
+        if path not in self.server.files:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        contents = self.server.files[path]
+        etag = '"%x"' % hash(contents)
+        if self.headers.getheader('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(contents)))
+        self.end_headers()
+        self.wfile.write(contents)
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    server = StandInServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+def make_fs(server):
+    return HttpFileSystem(server.base_url, source_cache=SourceCache(),
+                          transport=HttpTransport(timeout=5))
+
+def stop(server, fs):
+    fs.transport.close()
+    server.shutdown()
+    server.server_close()
+
+def test_connections_are_reused():
+    server = start_server()
+    server.files['a.js'] = 'exports.a = 1;'
+    server.files['b.js'] = 'exports.b = 2;'
+    fs = make_fs(server)
+    assert fs.read(server.base_url + 'a.js') == 'exports.a = 1;'
+    assert fs.read(server.base_url + 'b.js') == 'exports.b = 2;'
+    assert server.requests == 2
+    assert server.connections == 1
+    stop(server, fs)
+
+def test_cached_sources_are_revalidated():
+    server = start_server()
+    server.files['a.js'] = 'exports.a = 1;'
+    fs = make_fs(server)
+    url = fs.find_module(server.base_url, 'a')
+    assert fs.read(url) == 'exports.a = 1;'
+    assert fs.read(url) == 'exports.a = 1;'
+    assert fs.source_cache.hits == 1
+    server.files['a.js'] = 'exports.a = 2;'
+    assert fs.open(url).read() == 'exports.a = 2;'
+    assert fs.source_cache.misses == 2
+    stop(server, fs)
+
+def test_missing_sources_raise_ioerror():
+    server = start_server()
+    fs = make_fs(server)
+    try:
+        fs.read(server.base_url + 'missing.js')
+    except IOError:
+        pass
+    else:
+        raise AssertionError("Expected IOError")
+    stop(server, fs)
+
+def test_prefetch():
+    server = start_server()
+    urls = []
+    for i in range(20):
+        server.files['m%d.js' % i] = 'exports.i = %d;' % i
+        urls.append('%sm%d.js' % (server.base_url, i))
+    fs = make_fs(server)
+    results = fs.prefetch(urls + [server.base_url + 'missing.js'],
+                          max_workers=4)
+    assert results[urls[3]] == 'exports.i = 3;'
+    assert results[server.base_url + 'missing.js'] is None
+    assert server.connections <= 4
+    assert fs.read(urls[7]) == 'exports.i = 7;'
+    assert fs.source_cache.hits == 1
+    stop(server, fs)
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
@@ -0,0 +1,164 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for preloading modules into sandboxes, run against a local
+    stand-in HTTP server.
+"""
+
+import os
+import sys
+import threading
+import traceback
+
+from pydertron import (AsyncJsSandbox, JsSandbox, ModuleBundle,
+                       SandboxForkServer)
+from test_http import start_server, make_fs, stop
+
+MODULES = {
+    'program.js': 'var lib = require("lib");\n'
+                  'exports.answer = lib.value * 2;\n',
+    'lib.js': 'exports.value = 21;\n',
+    }
+
+def start_module_server():
+    server = start_server()
+    server.files.update(MODULES)
+    return server
+
+def test_bundle_is_built_from_the_module_graph():
+    server = start_module_server()
+    fs = make_fs(server)
+    bundle = ModuleBundle.build(fs, ['program', 'missing'])
+    program = server.base_url + 'program.js'
+    lib = server.base_url + 'lib.js'
+    assert bundle.sources.keys() == [program, lib]
+    assert bundle.find_module('<string>', 'program') == program
+    assert bundle.find_module(program, 'lib') == lib
+    assert (server.base_url + 'missing.js') not in bundle
+    stop(server, fs)
+
+def test_preloaded_modules_need_no_file_system():
+    server = start_module_server()
+    fs = make_fs(server)
+    bundle = ModuleBundle.build(fs, ['program'])
+    stop(server, fs)
+    results = []
+    sandbox = JsSandbox(fs)
+    try:
+        sandbox.preload(bundle)
+        assert sandbox.run_script("require('program').answer",
+                                  callback=results.append) == 0
+    finally:
+        sandbox.finish()
+    assert results == [42]
+
+def test_prefetched_modules_are_preloaded():
+    server = start_module_server()
+    fs = make_fs(server)
+    async_sandbox = AsyncJsSandbox(fs)
+    try:
+        loaded = async_sandbox.prefetch(['program']).result(10)
+        assert loaded == [server.base_url + 'program.js',
+                          server.base_url + 'lib.js']
+        requests = server.requests
+        results = []
+        assert async_sandbox.run_script("require('program').answer",
+                                        callback=results.append
+                                        ).result(10) == 0
+        assert results == [42]
+        assert server.requests == requests
+    finally:
+        async_sandbox.finish().result(10)
+        stop(server, fs)
+
+def test_fork_server_requires_modules_once():
+    if not hasattr(os, 'fork'):
+        return
+    server = start_module_server()
+    fs = make_fs(server)
+    fork_server = SandboxForkServer(fs, modules=['program'])
+    try:
+        # The template has already required the modules, so jobs
+        # don't fetch them again.
+        requests = server.requests
+        outcome = fork_server.submit("require('program').answer",
+                                     timeout=10).result()
+        assert outcome['retval'] == 0
+        assert outcome['result'] == 42
+        assert server.requests == requests
+    finally:
+        fork_server.close()
+        stop(server, fs)
+
+def test_fork_server_rejects_other_threads():
+    if not hasattr(os, 'fork'):
+        return
+    server = start_module_server()
+    fs = make_fs(server)
+    fork_server = SandboxForkServer(fs)
+    errors = []
+    def submit():
+        try:
+            fork_server.submit("1")
+        except RuntimeError, e:
+            errors.append(e)
+    try:
+        other = threading.Thread(target=submit)
+        other.start()
+        other.join()
+        assert len(errors) == 1
+    finally:
+        fork_server.close()
+        stop(server, fs)
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
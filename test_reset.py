@@ -0,0 +1,203 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+"""
+    Tests that JsSandbox.reset() isolates the code run before a reset
+    from the code run after it.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import traceback
+import StringIO
+
+from pydertron import JsSandbox, JsExposedObject, LocalFileSystem, jsexposed
+
+# A trusted module that holds on to whatever it's given, to stand in
+# for any way in which a JS reference could survive a reset.
+STASH_MODULE = """
+var stash = [];
+exports.id = Math.random();
+exports.save = function(value) { stash.push(value); };
+exports.callSaved = function() {
+  try {
+    return String(stash[0]());
+  } catch (e) {
+    return 'error';
+  }
+};
+exports.callSavedMethod = function() {
+  try {
+    return String(stash[0].reveal());
+  } catch (e) {
+    return 'error';
+  }
+};
+exports.applyToSaved = function(method) {
+  try {
+    return String(method.call(stash[0]));
+  } catch (e) {
+    return 'error';
+  }
+};
+"""
+
+TAMPERING_SCRIPTS = [
+    "Date.prototype.getFullYear = function() { return 0; };",
+    "Date.prototype.setFullYear = null;",
+    "String.prototype.bold = null;",
+    "String.prototype.quote = null;",
+    "Array.isArray = function() { return false; };",
+    "Array.prototype.push = function() {};",
+    "Object.prototype.leak = 'tenant A';",
+    "Math.max.leak = 'tenant A';",
+    "Function.prototype.apply = null;",
+    "this.__proto__.leak = 'tenant A';",
+    "Object.prototype.__defineGetter__('leak', function() { return 1; });",
+    ]
+
+class Secret(JsExposedObject):
+    @jsexposed
+    def reveal(self):
+        return 'tenant A'
+
+@jsexposed
+def get_secret():
+    return 'tenant A'
+
+@jsexposed
+def get_other():
+    return 'other'
+
+def make_sandbox(**kwargs):
+    root_dir = tempfile.mkdtemp()
+    f = open(os.path.join(root_dir, 'stash.js'), 'w')
+    try:
+        f.write(STASH_MODULE)
+    finally:
+        f.close()
+    sandbox = JsSandbox(LocalFileSystem(root_dir), **kwargs)
+    sandbox.root_dir = root_dir
+    return sandbox
+
+def finish(sandbox):
+    sandbox.finish()
+    shutil.rmtree(sandbox.root_dir)
+
+def run(sandbox, contents):
+    results = []
+    stderr = StringIO.StringIO()
+    status = sandbox.run_script(contents, callback=results.append,
+                                stderr=stderr)
+    assert status == 0, stderr.getvalue()
+    return results[0]
+
+def test_state_is_discarded():
+    sandbox = make_sandbox()
+    sandbox.set_globals(secret='tenant A')
+    run(sandbox, "var leftover = secret;")
+    assert sandbox.reset()
+    assert run(sandbox, "typeof(leftover) + typeof(secret)") == (
+        'undefinedundefined')
+    finish(sandbox)
+
+def test_tampering_refuses_reset():
+    for script in TAMPERING_SCRIPTS:
+        sandbox = make_sandbox()
+        run(sandbox, script)
+        assert not sandbox.reset(), script
+        finish(sandbox)
+
+def test_kept_modules_survive():
+    sandbox = make_sandbox()
+    first_id = run(sandbox, "require('stash').id")
+    assert sandbox.reset(keep_modules=['stash'])
+    assert run(sandbox, "require('stash').id") == first_id
+    finish(sandbox)
+
+def test_exposed_functions_are_disowned():
+    sandbox = make_sandbox()
+    run(sandbox, "require('stash')")
+    sandbox.set_globals(getSecret=get_secret)
+    run(sandbox, "require('stash').save(getSecret)")
+    assert run(sandbox, "require('stash').callSaved()") == 'tenant A'
+    assert sandbox.reset(keep_modules=['stash'])
+    assert run(sandbox, "require('stash').callSaved()") == 'error'
+    finish(sandbox)
+
+def test_evicted_functions_are_disowned():
+    sandbox = make_sandbox(max_bridged_functions=1)
+    run(sandbox, "require('stash')")
+    sandbox.set_globals(getSecret=get_secret)
+    run(sandbox, "require('stash').save(getSecret)")
+    sandbox.set_globals(getOther=get_other)
+    assert sandbox.bridge_stats()['evicted_functions'] >= 1
+    assert sandbox.reset(keep_modules=['stash'])
+    assert run(sandbox, "require('stash').callSaved()") == 'error'
+    finish(sandbox)
+
+def test_exposed_instances_are_disowned():
+    sandbox = make_sandbox()
+    run(sandbox, "require('stash')")
+    sandbox.set_globals(secret=Secret())
+    run(sandbox, "require('stash').save(secret)")
+    assert run(sandbox, "require('stash').callSavedMethod()") == 'tenant A'
+    assert sandbox.reset(keep_modules=['stash'])
+    sandbox.set_globals(other=Secret())
+    assert run(sandbox, "require('stash').callSavedMethod()") == 'error'
+    # Methods from after the reset can't be applied to old instances.
+    assert run(sandbox, "require('stash').applyToSaved(other.reveal)") == (
+        'error')
+    finish(sandbox)
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
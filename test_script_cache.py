@@ -0,0 +1,141 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for the cache of compiled scripts shared by sandboxes.
+"""
+
+import sys
+import traceback
+
+from pydertron import JsSandbox, LocalFileSystem, ScriptCache
+
+class FakeContext(object):
+    """
+    Stands in for a pydermonkey.Context, "compiling" scripts into
+    tuples and counting how many it has compiled.
+    """
+
+    def __init__(self):
+        self.compiled = 0
+
+    def compile_script(self, obj, contents, filename, lineno):
+        self.compiled += 1
+        return (contents, filename, lineno)
+
+def test_scripts_are_compiled_once():
+    cache = ScriptCache()
+    rt, cx = object(), FakeContext()
+    for i in range(3):
+        script = cache.compile(rt, cx, None, 'var a = 1;', 'a.js', 1)
+        assert script == ('var a = 1;', 'a.js', 1)
+    assert cx.compiled == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+    # Changed contents are compiled again.
+    cache.compile(rt, cx, None, 'var a = 2;', 'a.js', 1)
+    assert cx.compiled == 2
+
+def test_scripts_are_not_shared_between_runtimes():
+    cache = ScriptCache()
+    cx = FakeContext()
+    for rt in [object(), object()]:
+        cache.compile(rt, cx, None, 'var a = 1;', 'a.js', 1)
+    assert cx.compiled == 2
+    assert len(cache) == 2
+
+def test_least_recently_used_scripts_are_evicted():
+    cache = ScriptCache(max_entries=2)
+    rt, cx = object(), FakeContext()
+    cache.compile(rt, cx, None, 'a', 'a.js', 1)
+    cache.compile(rt, cx, None, 'b', 'b.js', 1)
+    cache.compile(rt, cx, None, 'a', 'a.js', 1)
+    cache.compile(rt, cx, None, 'c', 'c.js', 1)
+    assert len(cache) == 2
+    cache.compile(rt, cx, None, 'a', 'a.js', 1)
+    assert cx.compiled == 3
+    cache.compile(rt, cx, None, 'b', 'b.js', 1)
+    assert cx.compiled == 4
+
+def test_each_runtime_has_its_own_budget():
+    cache = ScriptCache(max_entries=2)
+    cx = FakeContext()
+    modules_rt, scripts_rt = object(), object()
+    cache.compile(modules_rt, cx, None, 'a', 'a.js', 1)
+    for i in range(10):
+        cache.compile(scripts_rt, cx, None, str(i), '<string>', 1)
+    compiled = cx.compiled
+    cache.compile(modules_rt, cx, None, 'a', 'a.js', 1)
+    assert cx.compiled == compiled
+
+def test_purge_removes_a_runtimes_scripts():
+    cache = ScriptCache()
+    cx = FakeContext()
+    rt, other_rt = object(), object()
+    cache.compile(rt, cx, None, 'a', 'a.js', 1)
+    cache.compile(other_rt, cx, None, 'a', 'a.js', 1)
+    cache.purge(rt)
+    assert len(cache) == 1
+    cache.compile(other_rt, cx, None, 'a', 'a.js', 1)
+    assert cx.compiled == 2
+
+def test_finish_purges_the_sandboxs_scripts():
+    cache = ScriptCache()
+    sandbox = JsSandbox(LocalFileSystem('.'), script_cache=cache)
+    try:
+        sandbox.run_script("var a = 1;")
+        sandbox.run_script("var a = 1;")
+        assert (cache.hits, cache.misses) == (1, 1)
+    finally:
+        sandbox.finish()
+    assert len(cache) == 0
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
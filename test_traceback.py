@@ -0,0 +1,155 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for the formatting of JS stack tracebacks and the cache of
+    source lines they're built from.
+"""
+
+import StringIO
+import sys
+import traceback
+
+from pydertron import LineCache, format_stack
+
+SOURCES = {
+    'a.js': 'var a = 1;\nthrow a;\n',
+    'b.js': 'require("a");\n',
+    }
+
+class FakeScript(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+class CountingOpen(object):
+    """
+    Stands in for a file system's open(), counting how many times
+    each file is opened.
+    """
+
+    def __init__(self, sources=SOURCES):
+        self.sources = sources
+        self.opened = {}
+
+    def __call__(self, filename):
+        self.opened[filename] = self.opened.get(filename, 0) + 1
+        return StringIO.StringIO(self.sources[filename])
+
+def make_stack(*frames):
+    # Builds a JS stack like the one returned by get_stack(), from
+    # (filename, lineno) frames, innermost first.
+    stack = None
+    for filename, lineno in reversed(frames):
+        stack = dict(script = FakeScript(filename),
+                     function = None,
+                     lineno = lineno,
+                     caller = stack)
+    return stack
+
+def test_format_stack_reads_each_file_once():
+    open = CountingOpen()
+    cache = LineCache()
+    stack = make_stack(('a.js', 2), ('b.js', 1))
+    expected = '\n'.join([
+        'Traceback (most recent call last):',
+        '  File "b.js", line 1, in <module>',
+        '    require("a");',
+        '  File "a.js", line 2, in <module>',
+        '    throw a;',
+        ])
+    for i in range(3):
+        assert format_stack(stack, open, cache) == expected
+    assert open.opened == {'a.js': 1, 'b.js': 1}
+
+def test_format_stack_without_cache_reads_every_time():
+    open = CountingOpen()
+    stack = make_stack(('a.js', 2))
+    for i in range(3):
+        format_stack(stack, open, None)
+    assert open.opened == {'a.js': 3}
+
+def test_format_stack_skips_unreadable_lines():
+    stack = make_stack(('missing.js', 1), ('a.js', 99))
+    assert format_stack(stack, CountingOpen(), LineCache()) == '\n'.join([
+        'Traceback (most recent call last):',
+        '  File "a.js", line 99, in <module>',
+        '  File "missing.js", line 1, in <module>',
+        ])
+
+def test_entries_are_bounded_across_open_functions():
+    cache = LineCache(max_entries=2)
+    opens = [CountingOpen() for i in range(5)]
+    for open in opens:
+        cache.getlines('a.js', open)
+    assert len(cache._entries) == 2
+    # Only the most recently used entries are kept.
+    cache.getlines('a.js', opens[-1])
+    cache.getlines('a.js', opens[0])
+    assert opens[-1].opened == {'a.js': 1}
+    assert opens[0].opened == {'a.js': 2}
+
+def test_invalidate_removes_every_entry_for_a_file():
+    cache = LineCache()
+    first, second = CountingOpen(), CountingOpen()
+    for open in [first, second]:
+        cache.getlines('a.js', open)
+        cache.getlines('b.js', open)
+    cache.invalidate('a.js')
+    for open in [first, second]:
+        cache.getlines('a.js', open)
+        cache.getlines('b.js', open)
+        assert open.opened == {'a.js': 2, 'b.js': 1}
+    cache.invalidate()
+    cache.getlines('b.js', first)
+    assert first.opened['b.js'] == 2
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
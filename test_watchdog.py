@@ -0,0 +1,163 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+"""
+    Tests for Pydertron's context watchdog, run against stand-in
+    contexts that record when their operation callbacks are
+    triggered.
+"""
+
+import gc
+import sys
+import time
+import traceback
+
+from pydertron import ContextWatchdogThread
+
+class FakeContext(object):
+    def __init__(self):
+        self.triggers = []
+
+    def trigger_operation_callback(self):
+        self.triggers.append(time.time())
+
+def start_watchdog(interval=ContextWatchdogThread.DEFAULT_INTERVAL):
+    watchdog = ContextWatchdogThread(interval)
+    watchdog.setDaemon(True)
+    watchdog.start()
+    return watchdog
+
+def test_contexts_are_triggered_at_their_own_intervals():
+    watchdog = start_watchdog()
+    fast = FakeContext()
+    slow = FakeContext()
+    watchdog.add_context(fast, 0.01)
+    watchdog.add_context(slow, 0.1)
+    time.sleep(0.5)
+    watchdog.join()
+    assert len(fast.triggers) >= 20, len(fast.triggers)
+    assert 2 <= len(slow.triggers) <= 6, len(slow.triggers)
+
+def test_default_interval_is_used():
+    watchdog = start_watchdog(0.05)
+    cx = FakeContext()
+    watchdog.add_context(cx)
+    time.sleep(0.3)
+    watchdog.join()
+    assert 3 <= len(cx.triggers) <= 7, len(cx.triggers)
+
+def test_removed_contexts_are_not_triggered():
+    watchdog = start_watchdog()
+    cx = FakeContext()
+    watchdog.add_context(cx, 0.01)
+    time.sleep(0.05)
+    watchdog.remove_context(cx)
+    count = len(cx.triggers)
+    time.sleep(0.1)
+    watchdog.join()
+    assert count > 0
+    assert len(cx.triggers) == count
+    assert not watchdog._entries
+
+def test_set_interval_wakes_the_watchdog():
+    watchdog = start_watchdog()
+    cx = FakeContext()
+    watchdog.add_context(cx, 60)
+    time.sleep(0.05)
+    start = time.time()
+    watchdog.set_interval(cx, 0.01)
+    time.sleep(0.1)
+    watchdog.join()
+    assert cx.triggers, "Context wasn't triggered"
+    assert cx.triggers[0] - start < 0.05
+
+def test_dead_contexts_are_forgotten():
+    watchdog = start_watchdog()
+    cx = FakeContext()
+    watchdog.add_context(cx, 0.01)
+    del cx
+    gc.collect()
+    time.sleep(0.05)
+    watchdog.join()
+    assert not watchdog._entries
+    assert not watchdog._heap
+
+def test_cancelled_entries_are_compacted():
+    watchdog = start_watchdog()
+    contexts = [FakeContext() for i in range(100)]
+    for cx in contexts:
+        watchdog.add_context(cx, 60)
+    for i in range(10):
+        for cx in contexts:
+            watchdog.set_interval(cx, 60 + i)
+    assert len(watchdog._heap) <= 2 * len(contexts)
+    for cx in contexts:
+        watchdog.remove_context(cx)
+    assert len(watchdog._heap) <= len(contexts)
+    watchdog.join()
+
+def test_contexts_can_be_adopted():
+    old_watchdog = start_watchdog()
+    kept = FakeContext()
+    removed = FakeContext()
+    old_watchdog.add_context(kept, 0.01)
+    old_watchdog.add_context(removed, 0.01)
+    old_watchdog.remove_context(removed)
+    old_watchdog.join()
+    new_watchdog = start_watchdog()
+    new_watchdog._adopt_contexts(old_watchdog)
+    count = len(kept.triggers)
+    time.sleep(0.1)
+    new_watchdog.join()
+    assert len(kept.triggers) > count
+    assert new_watchdog._entries.keys() == [id(kept)]
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])
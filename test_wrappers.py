@@ -0,0 +1,117 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Pydertron.
+#
+# The Initial Developer of the Original Code is Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2007
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Atul Varma <atul@mozilla.com>
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+
+
+"""
+    Tests for the identity cache of the wrappers JsSandbox creates for
+    JS objects.
+"""
+
+import gc
+import sys
+import traceback
+
+from pydertron import JsSandbox, LocalFileSystem
+
+def make_sandbox():
+    sandbox = JsSandbox(LocalFileSystem('.'))
+    sandbox.run_script("var o = {}; var other = {};")
+    return sandbox
+
+def test_wrappers_are_reused_while_alive():
+    sandbox = make_sandbox()
+    try:
+        wrapper = sandbox.root.o
+        jsobject = wrapper.wrapped_jsobject
+        assert sandbox.wrap_jsobject(jsobject) is wrapper
+        assert sandbox.wrap_jsobject(jsobject) is sandbox.root.o
+    finally:
+        sandbox.finish()
+
+def test_wrappers_depend_on_this():
+    sandbox = make_sandbox()
+    try:
+        wrapper = sandbox.root.o
+        other = sandbox.root.other.wrapped_jsobject
+        bound = sandbox.wrap_jsobject(wrapper.wrapped_jsobject, other)
+        assert bound is not wrapper
+        assert bound == wrapper
+        assert sandbox.wrap_jsobject(wrapper.wrapped_jsobject,
+                                     other) is bound
+    finally:
+        sandbox.finish()
+
+def test_entries_go_away_with_their_wrappers():
+    sandbox = make_sandbox()
+    try:
+        live = sandbox.wrapper_stats()['live']
+        wrapper = sandbox.root.o
+        assert sandbox.wrapper_stats()['live'] == live + 1
+        del wrapper
+        gc.collect()
+        assert sandbox.wrapper_stats()['live'] == live
+    finally:
+        sandbox.finish()
+
+def test_hits_and_allocations_are_counted():
+    sandbox = make_sandbox()
+    try:
+        before = sandbox.wrapper_stats()
+        wrapper = sandbox.root.o
+        for i in range(3):
+            assert sandbox.root.o is wrapper
+        after = sandbox.wrapper_stats()
+        assert after['allocations'] - before['allocations'] == 1
+        assert after['hits'] - before['hits'] == 3
+    finally:
+        sandbox.finish()
+
+if __name__ == '__main__':
+    totals = {'pass': 0, 'fail': 0}
+    names = sorted(name for name in globals() if name.startswith('test_'))
+    for name in names:
+        try:
+            globals()[name]()
+            print "PASS %s" % name
+            totals['pass'] += 1
+        except Exception:
+            print "FAIL %s" % name
+            traceback.print_exc()
+            totals['fail'] += 1
+
+    print "passed: %(pass)d  failed: %(fail)d" % totals
+    sys.exit(totals['fail'])